@@ -1,5 +1,6 @@
 import click
 import functools
+import itertools
 import json
 import operator
 import os
@@ -7,24 +8,46 @@ from pathlib import Path
 import shutil
 import subprocess
 import sys
+import threading
+import time
 import yaml
 
+from .cache import (
+    cache_stats,
+    check_cache_dir,
+    default_cache_size,
+    format_size,
+    parse_size,
+    prune_cache,
+    setup_build_cache,
+)
+from .catalog import catalog
+from .index import add_packages, check_subdir, index_channel, iter_subdirs
+from .manifest import (
+    is_up_to_date,
+    read_manifest,
+    recipe_channels,
+    recipe_fingerprint,
+    write_manifest,
+)
+from .publication import default_retention, publish_files, transport_for
+from .retention import default_rules, select_obsolete
+from .scheduler import run_jobs, print_summary
+from .state import (
+    diff_files,
+    is_package_file,
+    read_state,
+    scan_channel,
+    write_state,
+)
+
 default_channel_dir = "/drf/neuro-forge/public"
 default_recipes_dir = "/drf/neuro-forge/recipes"
 
 
 def find_neuro_forge_packages(recipes_dir=default_recipes_dir):
     neuro_forge = Path(__file__).parent.parent
-    recipes_dir = Path(recipes_dir)
-    if recipes_dir.exists():
-        yield from (
-            i.name for i in recipes_dir.iterdir() if (i / "recipe.yaml").exists()
-        )
-    yield from (
-        i.name
-        for i in (neuro_forge / "recipes").iterdir()
-        if (i / "recipe.yaml").exists()
-    )
+    yield from catalog([recipes_dir, neuro_forge / "recipes"])
 
 
 @click.group(context_settings={"help_option_names": ["-h", "--help"]})
@@ -32,171 +55,488 @@ def main():
     pass
 
 
+def build_package(
+    channel_dir,
+    recipe_dir,
+    log_file,
+    echo,
+    index_lock,
+    manifest,
+    fingerprint,
+    cache_dir=None,
+):
+    """
+    Build a single package with rattler-build in an isolated directory
+    (used as HOME and output directory) and move the created files in
+    channel_dir. All output is written in log_file and also on stdout if
+    echo is True. Downloaded sources and packages are stored in cache_dir
+    (channel_dir/.cache by default) that is shared by all builds. On success, the created files and the
+    recipe fingerprint are recorded in the build manifest and True is
+    returned.
+    """
+    package = recipe_dir.name
+    job_dir = channel_dir / "bld" / "jobs" / package
+    if job_dir.exists():
+        shutil.rmtree(job_dir)
+    job_dir.mkdir(parents=True)
+    channels = recipe_channels(recipe_dir)
+    env = {"HOME": str(job_dir)}
+    # Without persistent cache, all builds of a run share a cache located
+    # in channel_dir/.cache that is removed at the end of the run.
+    if cache_dir is None:
+        cache_dir = channel_dir / ".cache"
+    env.update(setup_build_cache(cache_dir, job_dir))
+
+    command = (
+        ["env"]
+        + [f"{k}={v}" for k, v in env.items()]
+        + [
+            "rattler-build",
+            "build",
+            "-r",
+            str(recipe_dir),
+            "--output-dir",
+            str(job_dir),
+            "--experimental",
+        ]
+        + functools.reduce(
+            operator.add, (["-c", i] for i in [f"file://{channel_dir}"] + channels)
+        )
+    )
+    variants = recipe_dir / "variants.yaml"
+    if variants.exists():
+        command.extend(["-m", str(variants)])
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_file, "w") as log:
+        for f in ([log, sys.stdout] if echo else [log]):
+            print("#----------------- calling ------------------------------", file=f)
+            print(" ".join(f"'{i}'" for i in command), file=f)
+            print("#--------------------------------------------------------", file=f)
+        if not echo:
+            print(f"Building {package} (log in {log_file})", flush=True)
+        p = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+        )
+        for line in p.stdout:
+            log.write(line)
+            if echo:
+                sys.stdout.write(line)
+        if p.wait():
+            print(f"\nERROR: building of package {package} failed", file=sys.stderr)
+            return False
+
+    # Move created packages in the channel and make them available to
+    # other jobs
+    with index_lock:
+        files = add_packages(channel_dir, job_dir)
+        manifest[package] = {
+            "fingerprint": fingerprint,
+            "files": sorted(files),
+            "time": time.time(),
+        }
+        write_manifest(channel_dir, manifest)
+    shutil.rmtree(job_dir)
+    return True
+
+
 @main.command()
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="Maximum number of packages built simultaneously",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(),
+    envvar="NEURO_FORGE_CACHE_DIR",
+    default=None,
+    help="Persistent directory (outside CHANNEL_DIR) used to keep downloaded "
+    "sources and packages between builds",
+)
+@click.option(
+    "--cache-size",
+    type=str,
+    envvar="NEURO_FORGE_CACHE_SIZE",
+    default=default_cache_size,
+    show_default=True,
+    help="Maximum size of the cache directory",
+)
 @click.argument("channel_dir", type=click.Path())
 @click.argument("packages", type=str, nargs=-1)
-def build(channel_dir, packages):
+def build(channel_dir, packages, jobs, cache_dir, cache_size):
     """Create packages with rattler-build for recipes embedded in neuro-forge
     without leaving any cache file in user environment. All temporary files are
     stored (and removed if operation is successful) in CHANNEL_DIR directory.
+    Downloaded sources and packages can be kept between runs in a directory
+    given with --cache-dir option (or NEURO_FORGE_CACHE_DIR variable).
+    Packages that do not depend on each other can be built simultaneously
+    with --jobs option. In that case, the output of each build is written in
+    a log file in CHANNEL_DIR/bld/logs.
 
 
     CHANNEL_DIR directory where packages are going to be created
 
     PACKAGES    list of packages to generate (by default all the ones
-                that are not already in the channel)
+                whose recipe changed since their last build recorded in
+                CHANNEL_DIR/.neuro-forge/build.json)
     """
     # Create an empty channel
     channel_dir = Path(channel_dir).absolute()
+    if cache_dir:
+        cache_dir = check_cache_dir(cache_dir, channel_dir)
+        cache_size = parse_size(cache_size)
+    else:
+        cache_dir = None
 
     # Make sure channel_dir can be used as a channel
     channel_dir.mkdir(exist_ok=True)
     (channel_dir / "noarch").mkdir(exist_ok=True)
     (channel_dir / "linux-64").mkdir(exist_ok=True)
-    subprocess.check_call(["rattler-index", "fs", channel_dir])
+    index_channel(channel_dir)
 
     # Select packages
     neuro_forge = Path(__file__).parent.parent
+    recipes = catalog([neuro_forge / "recipes"])
+    manifest = read_manifest(channel_dir)
+    fingerprints = {}
     if not packages:
-        # Select packages for automatic building
+        # Select packages for automatic building: the ones whose recipe
+        # changed since their last build
         packages = []
-        for i in (neuro_forge / "recipes").iterdir():
-            if (i / "recipe.yaml").exists():
-                existing = list(channel_dir.glob(f"*/{i.name}-*.conda"))
-                if existing:
-                    print(f"Skip {i} because {existing[0]} exists")
-                    continue
-                with open(i / "recipe.yaml") as f:
-                    recipe = yaml.safe_load(f)
-                if not recipe.get("extra", {}).get("neuro-forge", {}).get("exclude"):
-                    packages.append(i.name)
+        for name, entry in sorted(recipes.items()):
+            if entry["exclude"]:
+                continue
+            fingerprints[name] = recipe_fingerprint(Path(entry["directory"]))
+            if is_up_to_date(channel_dir, manifest, name, fingerprints[name]):
+                print(f"Skip {name} because it is up to date")
+                continue
+            if name in manifest:
+                print(f"Select {name} because its recipe changed")
+            else:
+                print(f"Select {name} because it has no recorded build")
+            packages.append(name)
 
-    # Create selected packages
+    # Build the dependency graph of selected packages
+    dependencies = {}
     for package in packages:
-        recipe_file = neuro_forge / "recipes" / package / "recipe.yaml"
-        if not recipe_file.exists():
+        entry = recipes.get(package)
+        if entry is None:
+            recipe_file = neuro_forge / "recipes" / package / "recipe.yaml"
             raise ValueError(
                 f'Wrong package name "{package}": file {recipe_file} does not exist'
             )
-        recipe_dir = recipe_file.parent
-        extension_file = recipe_dir / "neuro-forge.yaml"
-        channels = ["conda-forge", "bioconda"]
-        if extension_file.exists():
-            with open(extension_file) as f:
-                extension = yaml.safe_load(f)
-            channels = extension.get("channels", channels)
-
-        command = [
-            "env",
-            f"HOME={channel_dir}",
-            "rattler-build",
-            "build",
-            "-r",
-            str(recipe_dir),
-            "--output-dir",
-            str(channel_dir),
-            "--experimental",
-        ] + functools.reduce(operator.add, (["-c", i] for i in channels))
-        variants = recipe_dir / "variants.yaml"
-        if variants.exists():
-            command.extend(["-m", str(variants)])
-        print("#----------------- calling ------------------------------")
-        print(" ".join(f"'{i}'" for i in command))
-        print("#--------------------------------------------------------")
-        if subprocess.call(command):
-            print(f"\nERROR: building of package {package} failed", file=sys.stderr)
-            sys.exit(1)
+        requirements = itertools.chain(*entry["requirements"].values())
+        dependencies[package] = set(requirements).intersection(packages).difference(
+            [package]
+        )
+        if package not in fingerprints:
+            fingerprints[package] = recipe_fingerprint(Path(entry["directory"]))
+
+    if not dependencies:
+        print("Nothing to build")
+        return
+
+    # Create selected packages
+    index_lock = threading.Lock()
+    log_dir = channel_dir / "bld" / "logs"
+    status = run_jobs(
+        dependencies,
+        lambda package: build_package(
+            channel_dir,
+            neuro_forge / "recipes" / package,
+            log_dir / f"{package}.log",
+            jobs == 1,
+            index_lock,
+            manifest,
+            fingerprints[package],
+            cache_dir,
+        ),
+        jobs,
+    )
+    print_summary(status)
+    if any(s != "success" for s in status.values()):
+        print(
+            f"\nERROR: some packages were not built, see logs in {log_dir}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
 
-    # Cleanup and create channel index
-    subprocess.check_call(["rattler-index", "fs", channel_dir, "--force"])
+    # Cleanup
     to_delete = [channel_dir / i for i in ("bld", "src_cache", ".rattler", ".cache")]
     to_delete.extend(channel_dir.glob("*/.cache"))
     for i in to_delete:
         if i.exists():
             shutil.rmtree(i)
+    if cache_dir:
+        removed, reclaimed = prune_cache(cache_dir, cache_size)
+        if removed:
+            print(
+                f"Removed {len(removed)} entries ({format_size(reclaimed)}) "
+                f"from cache {cache_dir}"
+            )
+
+
+@main.group("cache")
+@click.option(
+    "--cache-dir",
+    type=click.Path(exists=True, file_okay=False),
+    envvar="NEURO_FORGE_CACHE_DIR",
+    required=True,
+    help="Cache directory used by build command",
+)
+@click.pass_context
+def cache_group(ctx, cache_dir):
+    """Manage the persistent cache used by build command"""
+    ctx.obj = Path(cache_dir).absolute()
+
+
+@cache_group.command("stats")
+@click.pass_obj
+def cache_stats_command(cache_dir):
+    """Print the number of entries and size of the cache"""
+    total = 0
+    for area, s in sorted(cache_stats(cache_dir).items()):
+        print(f"{area:<20} {s['entries']:>8} entries {format_size(s['size']):>10}")
+        total += s["size"]
+    print(f"{'total':<20} {'':>17} {format_size(total):>10}")
+
+
+@cache_group.command("prune")
+@click.option(
+    "--max-size",
+    type=str,
+    envvar="NEURO_FORGE_CACHE_SIZE",
+    default=default_cache_size,
+    show_default=True,
+    help="Maximum size of the cache directory",
+)
+@click.option("--dry-run", is_flag=True, help="Only print entries to remove")
+@click.pass_obj
+def cache_prune(cache_dir, max_size, dry_run):
+    """Remove least recently used entries until cache size fits in
+    --max-size"""
+    removed, reclaimed = prune_cache(cache_dir, parse_size(max_size), dry_run)
+    for path in removed:
+        print(f"{'Would remove' if dry_run else 'Removed'} {path}")
+    print(f"{len(removed)} entries, {format_size(reclaimed)} reclaimed")
+
+
+def print_index_result(result):
+    for subdir, (added, removed) in result.items():
+        if added or removed:
+            print(f"{subdir}: {len(added)} entries updated, {len(removed)} removed")
+
+
+@main.command("index")
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Read all package files and rebuild repodata.json from scratch",
+)
+@click.option(
+    "--check",
+    is_flag=True,
+    help="Only check that all index files are consistent with repodata.json",
+)
+@click.argument("channel_dir", type=click.Path(exists=True, file_okay=False))
+def index_command(channel_dir, force, check):
+    """Update the index files of CHANNEL_DIR (repodata.json, its compressed
+    version, current_repodata.json and sharded repodata). Only new or
+    modified package files are read unless --force is used."""
+    if check:
+        errors = []
+        for subdir in iter_subdirs(channel_dir):
+            errors.extend(check_subdir(subdir))
+        for error in errors:
+            print(f"ERROR: {error}", file=sys.stderr)
+        if errors:
+            sys.exit(1)
+        return
+    print_index_result(index_channel(channel_dir, force=force))
 
 
 @main.command()
-def publish():
-    """Run rattler-index if necessary and publish channels"""
+@click.option(
+    "--keep",
+    type=int,
+    default=None,
+    help="Number of builds kept for each package version and build string "
+    f"(default={default_rules['keep']})",
+)
+@click.option(
+    "--dev-max-age",
+    type=int,
+    default=None,
+    help="Remove development environment packages (soma-env 0.x) older "
+    "than this number of days",
+)
+@click.option(
+    "--rules",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="YAML file with retention rules: global keep and dev_max_age "
+    "values and a packages dictionary with rules for package names or "
+    "patterns",
+)
+@click.option("--dry-run", is_flag=True, help="Only print files to remove")
+@click.argument("channel_dir", type=click.Path(exists=True, file_okay=False))
+def prune(channel_dir, keep, dev_max_age, rules, dry_run):
+    """Remove old packages from CHANNEL_DIR according to retention rules.
+    Packages referenced by a soma-env-*.json release history are always
+    kept. Only the affected subdirs are reindexed."""
+    channel_dir = Path(channel_dir).absolute()
+    if rules:
+        with open(rules) as f:
+            rules = yaml.safe_load(f) or {}
+    else:
+        rules = {}
+    if keep is not None:
+        rules["keep"] = keep
+    if dev_max_age is not None:
+        rules["dev_max_age"] = dev_max_age
+
+    reclaimed = 0
+    entries = 0
+    subdirs = set()
+    for subdir, file, record, reason in select_obsolete(channel_dir, rules):
+        print(f"{'Would remove' if dry_run else 'Remove'} {subdir}/{file}: {reason}")
+        path = channel_dir / subdir / file
+        if path.exists():
+            reclaimed += path.stat().st_size
+            if not dry_run:
+                path.unlink()
+        entries += 1
+        subdirs.add(subdir)
+    if subdirs and not dry_run:
+        repodata_size = sum(
+            (channel_dir / i / "repodata.json").stat().st_size for i in subdirs
+        )
+        index_channel(channel_dir, subdirs=subdirs)
+        repodata_size -= sum(
+            (channel_dir / i / "repodata.json").stat().st_size for i in subdirs
+        )
+        print(f"repodata.json size reduced by {format_size(repodata_size)}")
+    print(
+        f"{entries} repodata entries and {format_size(reclaimed)} "
+        f"{'can be' if dry_run else 'were'} reclaimed"
+    )
+
+
+def print_changes(title, changes):
+    for label, paths in zip(("new", "modified", "removed"), changes):
+        for path in paths:
+            print(f"{title}: {label} {path}")
+
+
+def publish_channel(name, info, check=False, full=False):
+    """
+    Index a channel if necessary and publish it according to its entry in
+    neuro-forge.json
+    """
+    channel_dir = info.get("directory")
+    if not channel_dir:
+        return
+    channel_dir = os.path.normpath(os.path.abspath(channel_dir))
+
+    # Compare channel files with the last recorded state
+    state = read_state(channel_dir)
+    files, directories = scan_channel(channel_dir, state, full=full)
+    changes = diff_files(state.get("files", {}), files)
+    to_index = {
+        i.split("/", 1)[0]
+        for i in itertools.chain(*changes)
+        if "/" in i and is_package_file(i)
+    }
+    if full or not (Path(channel_dir) / "noarch" / "repodata.json").exists():
+        to_index = None
+    published = state.get("published", {}).get(name)
+    transport = transport_for(info)
+    if check:
+        if to_index is None:
+            print(f"{name}: full index")
+        elif to_index:
+            print(f"{name}: index {', '.join(sorted(to_index))}")
+        print_changes(f"{name}: local", changes)
+        if transport is not None:
+            if published is None:
+                print(f"{name}: never published, all files would be sent")
+            else:
+                print_changes(f"{name}: publish", diff_files(published, files))
+            transport.close()
+        return
+
+    # Index only subdirs containing new or modified package files
+    if to_index is None or to_index:
+        print_index_result(index_channel(channel_dir, subdirs=to_index))
+        # Only reindexed subdirs are scanned again
+        files, directories = scan_channel(
+            channel_dir,
+            {"files": files, "directories": directories},
+            subdirs=(
+                [i.name for i in iter_subdirs(channel_dir)]
+                if to_index is None
+                else to_index
+            ),
+        )
+    state["files"] = files
+    state["directories"] = directories
+    write_state(channel_dir, state)
+
+    if transport is None:
+        return
+    with transport:
+        if published is not None and not any(diff_files(published, files)):
+            print(f"{name}: nothing to publish")
+            return
+        # Only new or modified files are sent to a new generation of the
+        # remote channel. During the process, the published channel is
+        # untouched.
+        publish_files(
+            transport,
+            channel_dir,
+            files,
+            retention=info.get("retention", default_retention),
+        )
+    state.setdefault("published", {})[name] = files
+    write_state(channel_dir, state)
+
+
+@main.command()
+@click.option(
+    "--check",
+    is_flag=True,
+    help="Only report what would be indexed and published",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Ignore channels state and rescan all files",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help="Maximum number of channels published simultaneously (default=all)",
+)
+def publish(check, full, jobs):
+    """Update channels index if necessary and publish channels. Changes are
+    detected by comparing channel files with the state recorded in
+    .neuro-forge/state.json in each channel directory. Only new or modified
+    files are sent to remote channels."""
 
     pixi_root = Path(os.environ["PIXI_PROJECT_ROOT"])
     with open(pixi_root / "neuro-forge.json") as f:
         neuro_forge_conf = json.load(f)
 
-    for name, info in neuro_forge_conf["publication"].items():
-        print("-" * 40)
-        print(f"Processing {name}:")
-        print("-" * 40)
-        channel_dir = info.get("directory")
-        if channel_dir:
-            # Sort all files by modification date and get the most recent
-            to_sort = []
-            conda_time = 0
-            index_time = None
-            for root, _, files in os.walk(channel_dir):
-                for file in files:
-                    ff = os.path.join(root, file)
-                    if ff.endswith(".conda"):
-                        conda_time = max(conda_time, os.stat(ff).st_mtime)
-                    elif os.path.basename(ff) == 'repodata.json':
-                        index_time = os.stat(ff).st_mtime
-            if index_time is None or index_time < conda_time:
-                command = ["rattler-index", "fs", channel_dir, "--force"]
-                print(" ".join(f"'{i}'" for i in command))
-                subprocess.check_call(command)
-
-            if "ssh" in info:
-                destination = info["ssh"]["destination"]
-                directory = info["ssh"]["directory"]
-
-                # On web server, make a copy of the channel directory using hard links
-                command = [
-                    "ssh",
-                    f"{destination}",
-                    "cp",
-                    "-ral",
-                    f"{directory}",
-                    f"{directory}-update",
-                ]
-                print(" ".join(f"'{i}'" for i in command))
-                subprocess.check_call(command)
-
-                # Update the copy of the channel directory. This can take a while.
-                # During the process, the published channel is untouched.
-                channel_dir = os.path.normpath(os.path.abspath(channel_dir))
-                command = [
-                    "rsync",
-                    "-r",
-                    "--progress",
-                    "--delete",
-                    "--no-perms",
-                    "--times",
-                    "--no-owner",
-                    "--no-group",
-                    "--exclude=.cache",
-                    channel_dir + "/",
-                    f"{destination}:{directory}-update/neuro-forge/",
-                ]
-                print(" ".join(f"'{i}'" for i in command))
-                subprocess.check_call(command)
-
-                # Replace the remote channel by its updated copy
-                bash_script = f"""set -xe
-                chmod -R a+rx {directory}-update/neuro-forge
-                rm -Rf {directory}-update/backup/*
-                mv {directory}/* {directory}-update/backup
-                mv {directory}-update/neuro-forge/* {directory}
-                """
-                print(f"ssh {destination} /usr/bin/bash << EOF")
-                print(bash_script)
-                print("EOF")
-                p = subprocess.run(
-                    [
-                        "ssh",
-                        destination,
-                        "/usr/bin/bash",
-                    ],
-                    input=bash_script.encode(),
-                    check=True,
-                )
+    publication = neuro_forge_conf["publication"]
+    status = run_jobs(
+        {name: set() for name in publication},
+        lambda name: publish_channel(name, publication[name], check, full) or True,
+        jobs or len(publication),
+    )
+    if any(s != "success" for s in status.values()):
+        print_summary(status)
+        sys.exit(1)
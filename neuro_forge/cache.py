@@ -0,0 +1,135 @@
+import os
+from pathlib import Path
+import re
+import shutil
+
+"""
+Persistent cache for rattler-build. It is located outside of the channel
+directory and contains:
+    - src_cache: downloaded sources (rattler-build src_cache directory)
+    - rattler: rattler cache (downloaded packages and repodata) used via
+      RATTLER_CACHE_DIR environment variable.
+The cache has a size budget. When it is exceeded, the least recently used
+entries are removed.
+"""
+
+default_cache_size = "50G"
+
+size_units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size):
+    """
+    Convert a size such as "500M" or "50G" to a number of bytes
+    """
+    match = re.match(r"^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$", str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(match.group(1)) * size_units[match.group(2).upper()])
+
+
+def format_size(size):
+    for unit in ("T", "G", "M", "K"):
+        if size >= size_units[unit]:
+            return f"{size / size_units[unit]:.1f}{unit}"
+    return f"{size}B"
+
+
+def check_cache_dir(cache_dir, channel_dir):
+    """
+    Make sure that the cache directory is not part of the published channel
+    """
+    cache_dir = Path(cache_dir).absolute()
+    channel_dir = Path(channel_dir).absolute()
+    if cache_dir == channel_dir or channel_dir in cache_dir.parents:
+        raise ValueError(
+            f"Cache directory {cache_dir} must be outside of channel {channel_dir}"
+        )
+    return cache_dir
+
+
+def setup_build_cache(cache_dir, output_dir):
+    """
+    Make a rattler-build output directory use the persistent cache and
+    return the environment variables to add to rattler-build command.
+    """
+    (cache_dir / "src_cache").mkdir(parents=True, exist_ok=True)
+    (cache_dir / "rattler").mkdir(exist_ok=True)
+    src_cache = output_dir / "src_cache"
+    if not src_cache.is_symlink():
+        if src_cache.exists():
+            shutil.rmtree(src_cache)
+        src_cache.symlink_to(cache_dir / "src_cache")
+    return {"RATTLER_CACHE_DIR": str(cache_dir / "rattler")}
+
+
+def entry_info(path):
+    """
+    Return the size of a cache entry (file or directory) and the last time
+    it was used (maximum of access and modification times)
+    """
+    st = path.lstat()
+    size = st.st_size
+    last_use = max(st.st_atime, st.st_mtime)
+    if path.is_dir() and not path.is_symlink():
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                st = os.lstat(os.path.join(root, name))
+                size += st.st_size
+                last_use = max(last_use, st.st_atime, st.st_mtime)
+    return size, last_use
+
+
+def cache_entries(cache_dir):
+    """
+    Iterate over all the entries of a cache directory. Each entry is a
+    (path, size, last_use) tuple. Lock files are not considered as entries.
+    """
+    areas = [cache_dir / "src_cache"]
+    rattler = cache_dir / "rattler"
+    if rattler.exists():
+        areas.extend(i for i in rattler.iterdir() if i.is_dir())
+    for area in areas:
+        if not area.exists():
+            continue
+        for path in area.iterdir():
+            if path.name.startswith(".") or path.name.endswith(".lock"):
+                continue
+            yield (path,) + entry_info(path)
+
+
+def cache_stats(cache_dir):
+    """
+    Return a dictionary giving the number of entries and the size of each
+    cache area.
+    """
+    stats = {}
+    for path, size, last_use in cache_entries(cache_dir):
+        area = str(path.parent.relative_to(cache_dir))
+        s = stats.setdefault(area, {"entries": 0, "size": 0})
+        s["entries"] += 1
+        s["size"] += size
+    return stats
+
+
+def prune_cache(cache_dir, max_size, dry_run=False):
+    """
+    Remove least recently used entries until cache size is below max_size
+    bytes. Return the list of removed entries and the number of bytes
+    reclaimed.
+    """
+    entries = sorted(cache_entries(cache_dir), key=lambda i: i[2])
+    total = sum(i[1] for i in entries)
+    removed = []
+    reclaimed = 0
+    for path, size, last_use in entries:
+        if total - reclaimed <= max_size:
+            break
+        if not dry_run:
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+        removed.append(path)
+        reclaimed += size
+    return removed, reclaimed
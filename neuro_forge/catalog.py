@@ -0,0 +1,127 @@
+import os
+from pathlib import Path
+import re
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+from .json_cache import read_cache, user_cache_dir, write_cache
+
+"""
+Catalog of neuro-forge recipes. Each recipe.yaml (and optional
+neuro-forge.yaml) is parsed once and the information needed by neuro-forge
+commands is stored in an on-disk cache. A cache entry is reused as long as
+the modification time and size of the recipe files did not change.
+"""
+
+default_channels = ["conda-forge", "bioconda"]
+
+
+def requirement_names(recipe, sections=None):
+    """
+    Iterate over the names of packages listed in the requirements of a
+    rattler-build recipe (optionally only in the given sections).
+    Conditional requirements (if/then/else) are all considered.
+    """
+    requirements = recipe.get("requirements") or {}
+    stack = [v for k, v in requirements.items() if sections is None or k in sections]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, list):
+            stack.extend(item)
+        elif isinstance(item, dict):
+            stack.extend(v for k, v in item.items() if k in ("then", "else"))
+        elif isinstance(item, str):
+            match = re.match(r"\s*(?:[^\s:]+::)?([A-Za-z0-9_.\-]+)", item)
+            if match:
+                yield match.group(1)
+
+
+def load_yaml(file):
+    with open(file) as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+
+def file_key(file):
+    try:
+        st = os.stat(file)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def parse_recipe(recipe_dir):
+    """
+    Parse the files of a recipe directory and return its catalog entry
+    """
+    recipe = load_yaml(recipe_dir / "recipe.yaml") or {}
+    channels = default_channels
+    extension_file = recipe_dir / "neuro-forge.yaml"
+    if extension_file.exists():
+        channels = (load_yaml(extension_file) or {}).get("channels", channels)
+    package = recipe.get("package", {})
+    return {
+        "name": recipe_dir.name,
+        "directory": str(recipe_dir),
+        "package": package.get("name", recipe_dir.name),
+        "version": str(package.get("version", "")),
+        "requirements": {
+            section: sorted(set(requirement_names(recipe, [section])))
+            for section in (recipe.get("requirements") or {})
+        },
+        "exclude": bool(
+            (recipe.get("extra") or {}).get("neuro-forge", {}).get("exclude")
+        ),
+        "channels": channels,
+    }
+
+
+def catalog(recipes_dirs, cache_file=None):
+    """
+    Return a dictionary whose keys are recipe names (i.e. recipe directory
+    names) and values are catalog entries (see parse_recipe) for all recipes
+    found in recipes_dirs. If a recipe name exists in several directories,
+    the first one is used.
+    """
+    recipes_dirs = tuple(str(i) for i in recipes_dirs)
+    if cache_file is None:
+        cache_file = user_cache_dir() / "recipes-catalog.json"
+    cache = read_cache(cache_file)
+    directories = cache.setdefault("directories", {})
+    recipes = cache.setdefault("recipes", {})
+    modified = False
+    result = {}
+    for recipes_dir in recipes_dirs:
+        dir_key = file_key(recipes_dir)
+        if dir_key is None:
+            continue
+        listing = directories.get(recipes_dir)
+        if listing is None or listing["key"] != dir_key:
+            listing = {
+                "key": dir_key,
+                "names": sorted(i.name for i in Path(recipes_dir).iterdir()),
+            }
+            directories[recipes_dir] = listing
+            modified = True
+        for name in listing["names"]:
+            if name in result:
+                continue
+            recipe_dir = Path(recipes_dir) / name
+            key = [
+                file_key(recipe_dir / "recipe.yaml"),
+                file_key(recipe_dir / "neuro-forge.yaml"),
+            ]
+            if key[0] is None:
+                continue
+            cached = recipes.get(str(recipe_dir))
+            if cached is None or cached["key"] != key:
+                cached = {"key": key, "entry": parse_recipe(recipe_dir)}
+                recipes[str(recipe_dir)] = cached
+                modified = True
+            result[name] = cached["entry"]
+    if modified:
+        write_cache(cache_file, cache)
+    return result
@@ -0,0 +1,439 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import tarfile
+import tempfile
+import zipfile
+
+import msgpack
+import zstandard
+
+"""
+Incremental indexer for Conda channels. Instead of reading all package
+archives, only the ones that are not yet in repodata.json (or that changed
+since the last index) are read. Entries of removed archives are also
+removed. Besides repodata.json, a compressed version, a
+current_repodata.json and sharded repodata (CEP-16) are written. All files
+are written atomically.
+"""
+
+index_files = (
+    "repodata.json",
+    "repodata.json.zst",
+    "current_repodata.json",
+    "repodata_shards.msgpack.zst",
+)
+compression_level = 16
+
+# Mode of files created with open(). The umask can only be read by setting it.
+_umask = os.umask(0o22)
+os.umask(_umask)
+default_file_mode = 0o666 & ~_umask
+
+subdir_re = re.compile(
+    r"^(noarch|(linux|osx|win|emscripten|wasi|zos|freebsd)-[a-z0-9_]+)$"
+)
+
+
+def read_index_json(archive):
+    """
+    Return the content of info/index.json contained in a .conda or a
+    .tar.bz2 package archive.
+    """
+    archive = Path(archive)
+    if archive.name.endswith(".conda"):
+        with zipfile.ZipFile(archive) as z:
+            info = [i for i in z.namelist() if i.startswith("info-")]
+            if len(info) != 1:
+                raise ValueError(f"Cannot find info archive in {archive}")
+            with z.open(info[0]) as f:
+                reader = zstandard.ZstdDecompressor().stream_reader(f)
+                with tarfile.open(fileobj=reader, mode="r|") as tar:
+                    for member in tar:
+                        if member.name == "info/index.json":
+                            return json.load(tar.extractfile(member))
+    elif archive.name.endswith(".tar.bz2"):
+        with tarfile.open(archive, mode="r:bz2") as tar:
+            return json.load(tar.extractfile("info/index.json"))
+    raise ValueError(f"Cannot find info/index.json in {archive}")
+
+
+def package_record(archive):
+    """
+    Return the repodata record of a package archive
+    """
+    record = read_index_json(archive)
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(archive, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+    record["md5"] = md5.hexdigest()
+    record["sha256"] = sha256.hexdigest()
+    record["size"] = os.stat(archive).st_size
+    return record
+
+
+def read_repodata(subdir_dir):
+    repodata_file = Path(subdir_dir) / "repodata.json"
+    if repodata_file.exists():
+        with open(repodata_file) as f:
+            return json.load(f)
+    return None
+
+
+def write_atomic(file, content):
+    """
+    Write content (str or bytes) in file using a temporary file that is
+    renamed at the end. Readers see either the old or the new file.
+    """
+    file = Path(file)
+    # Each writer uses its own temporary file so that concurrent indexing
+    # of the same channel never mixes contents. Temporary files are created
+    # with 0600 mode, the default mode of new files is restored.
+    with tempfile.NamedTemporaryFile(
+        "wb" if isinstance(content, bytes) else "w",
+        dir=file.parent,
+        prefix=f".{file.name}",
+        delete=False,
+    ) as f:
+        try:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+            os.chmod(f.name, default_file_mode)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, file)
+
+
+def version_key(version):
+    """
+    Return a key to sort package versions (numeric components are compared
+    as numbers, other components as lower case strings)
+    """
+    return [
+        (1, int(i)) if i.isdigit() else (0, i.lower())
+        for i in re.findall(r"[0-9]+|[A-Za-z]+", version.split("+", 1)[0])
+    ]
+
+
+def current_repodata(repodata):
+    """
+    Return a copy of repodata containing only the latest version of each
+    package.
+    """
+    latest = {}
+    for key in ("packages", "packages.conda"):
+        for record in repodata.get(key, {}).values():
+            name = record["name"]
+            if name not in latest or version_key(record["version"]) > version_key(
+                latest[name]
+            ):
+                latest[name] = record["version"]
+    result = dict(repodata)
+    for key in ("packages", "packages.conda"):
+        result[key] = {
+            file: record
+            for file, record in repodata.get(key, {}).items()
+            if record["version"] == latest[record["name"]]
+        }
+    return result
+
+
+def shard_record(record):
+    """
+    Convert a repodata record to its sharded form where hashes are stored
+    as bytes (see CEP-16)
+    """
+    record = dict(record)
+    for key in ("md5", "sha256"):
+        if key in record:
+            record[key] = bytes.fromhex(record[key])
+    return record
+
+
+def repodata_shards(repodata):
+    """
+    Return a dictionary whose keys are package names and values are the
+    compressed shard (see CEP-16) containing all the records of that package.
+    """
+    shards = {}
+    for key in ("packages", "packages.conda"):
+        for file, record in repodata.get(key, {}).items():
+            shard = shards.setdefault(
+                record["name"], {"packages": {}, "packages.conda": {}, "removed": []}
+            )
+            shard[key][file] = shard_record(record)
+    compressor = zstandard.ZstdCompressor(level=compression_level)
+    return {
+        name: compressor.compress(msgpack.packb(shard, use_bin_type=True))
+        for name, shard in sorted(shards.items())
+    }
+
+
+def write_repodata(subdir_dir, repodata):
+    """
+    Write all the index files of a channel subdirectory:
+        - shards/*.msgpack.zst and repodata_shards.msgpack.zst: sharded
+          repodata following CEP-16 layout.
+        - current_repodata.json: repodata with only the latest version of
+          each package.
+        - repodata.json.zst: compressed repodata.json
+        - repodata.json
+    Each file is written atomically, repodata.json being the last one.
+    """
+    subdir_dir = Path(subdir_dir)
+    compressor = zstandard.ZstdCompressor(level=compression_level)
+
+    # Sharded repodata. Shards names are the sha256 of their content
+    shards_dir = subdir_dir / "shards"
+    shards_dir.mkdir(exist_ok=True)
+    shards_index = {
+        "version": 1,
+        "info": {
+            "base_url": "",
+            "shards_base_url": "./shards/",
+            "subdir": subdir_dir.name,
+        },
+        "shards": {},
+    }
+    for name, shard in repodata_shards(repodata).items():
+        digest = hashlib.sha256(shard).digest()
+        shards_index["shards"][name] = digest
+        shard_file = shards_dir / f"{digest.hex()}.msgpack.zst"
+        if not shard_file.exists():
+            write_atomic(shard_file, shard)
+    write_atomic(
+        subdir_dir / "repodata_shards.msgpack.zst",
+        compressor.compress(msgpack.packb(shards_index, use_bin_type=True)),
+    )
+    used = {f"{i.hex()}.msgpack.zst" for i in shards_index["shards"].values()}
+    for shard_file in shards_dir.iterdir():
+        if shard_file.name not in used:
+            shard_file.unlink()
+
+    write_atomic(
+        subdir_dir / "current_repodata.json",
+        json.dumps(current_repodata(repodata), indent=2, sort_keys=True),
+    )
+    content = json.dumps(repodata, indent=2, sort_keys=True)
+    write_atomic(
+        subdir_dir / "repodata.json.zst", compressor.compress(content.encode())
+    )
+    write_atomic(subdir_dir / "repodata.json", content)
+
+
+# Exceptions raised when reading a corrupted index file. msgpack errors are
+# ValueError subclasses, other errors come from unexpected content types.
+invalid_content_errors = (
+    zstandard.ZstdError,
+    ValueError,
+    KeyError,
+    TypeError,
+    AttributeError,
+)
+
+
+def check_subdir(subdir_dir):
+    """
+    Check that all index files of a channel subdirectory are consistent with
+    repodata.json. Return a list of error messages. Unreadable files are
+    reported as errors.
+    """
+    subdir_dir = Path(subdir_dir)
+    try:
+        repodata = read_repodata(subdir_dir)
+    except ValueError as e:
+        return [f"{subdir_dir / 'repodata.json'}: invalid content ({e})"]
+    if repodata is None:
+        return [f"{subdir_dir}: missing repodata.json"]
+
+    def records(data):
+        return {
+            (key, file): record
+            for key in ("packages", "packages.conda")
+            for file, record in data.get(key, {}).items()
+        }
+
+    errors = []
+    try:
+        expected = records(repodata)
+        names = {i["name"] for i in expected.values()}
+    except invalid_content_errors as e:
+        return [f"{subdir_dir / 'repodata.json'}: invalid content ({e})"]
+    decompressor = zstandard.ZstdDecompressor()
+
+    file = subdir_dir / "repodata.json.zst"
+    if not file.exists():
+        errors.append(f"{file}: missing")
+    else:
+        try:
+            if json.loads(decompressor.decompress(file.read_bytes())) != repodata:
+                errors.append(f"{file}: different from repodata.json")
+        except invalid_content_errors as e:
+            errors.append(f"{file}: invalid content ({e})")
+
+    file = subdir_dir / "current_repodata.json"
+    if not file.exists():
+        errors.append(f"{file}: missing")
+    else:
+        try:
+            with open(file) as f:
+                current = records(json.load(f))
+            if any(expected.get(k) != v for k, v in current.items()):
+                errors.append(f"{file}: contains records not in repodata.json")
+            if {i["name"] for i in current.values()} != names:
+                errors.append(f"{file}: does not list the same packages")
+        except invalid_content_errors as e:
+            errors.append(f"{file}: invalid content ({e})")
+
+    file = subdir_dir / "repodata_shards.msgpack.zst"
+    if not file.exists():
+        errors.append(f"{file}: missing")
+        return errors
+    try:
+        index = msgpack.unpackb(decompressor.decompress(file.read_bytes()))
+        shards = index["shards"].items()
+    except invalid_content_errors as e:
+        errors.append(f"{file}: invalid content ({e})")
+        return errors
+    sharded = {}
+    valid = True
+    for name, digest in shards:
+        try:
+            shard_file = subdir_dir / "shards" / f"{digest.hex()}.msgpack.zst"
+        except AttributeError:
+            errors.append(f"{file}: invalid digest for {name}")
+            valid = False
+            continue
+        if not shard_file.exists():
+            errors.append(f"{shard_file}: missing shard for {name}")
+            valid = False
+            continue
+        content = shard_file.read_bytes()
+        if hashlib.sha256(content).digest() != digest:
+            errors.append(f"{shard_file}: invalid sha256")
+            valid = False
+            continue
+        try:
+            sharded.update(records(msgpack.unpackb(decompressor.decompress(content))))
+        except invalid_content_errors as e:
+            errors.append(f"{shard_file}: invalid content ({e})")
+            valid = False
+    if valid and sharded != {k: shard_record(v) for k, v in expected.items()}:
+        errors.append(f"{file}: shards are different from repodata.json")
+    return errors
+
+
+def index_subdir(subdir_dir, force=False):
+    """
+    Update the repodata.json file of a channel subdirectory (e.g. linux-64).
+    Only archives that are not in the current repodata.json, or that are
+    more recent than it or whose size changed, are read. If force is True,
+    all archives are read. Return a (added, removed) tuple containing the
+    file names of updated and removed entries.
+    """
+    subdir_dir = Path(subdir_dir)
+    repodata = None if force else read_repodata(subdir_dir)
+    if repodata is None:
+        repodata = {
+            "info": {"subdir": subdir_dir.name},
+            "packages": {},
+            "packages.conda": {},
+            "removed": [],
+            "repodata_version": 1,
+        }
+        index_time = None
+    else:
+        index_time = (subdir_dir / "repodata.json").stat().st_mtime_ns
+
+    archives = {}
+    with os.scandir(subdir_dir) as it:
+        for entry in it:
+            if entry.is_file() and (
+                entry.name.endswith(".conda") or entry.name.endswith(".tar.bz2")
+            ):
+                archives[entry.name] = entry.stat()
+
+    added = []
+    removed = []
+    for key in ("packages", "packages.conda"):
+        for name in list(repodata.setdefault(key, {})):
+            if name not in archives:
+                del repodata[key][name]
+                removed.append(name)
+    for name, st in sorted(archives.items()):
+        key = "packages.conda" if name.endswith(".conda") else "packages"
+        record = repodata[key].get(name)
+        if (
+            record is not None
+            and index_time is not None
+            and st.st_mtime_ns < index_time
+            and record.get("size") == st.st_size
+        ):
+            continue
+        repodata[key][name] = package_record(subdir_dir / name)
+        added.append(name)
+
+    if (
+        added
+        or removed
+        or not all((subdir_dir / i).exists() for i in index_files)
+    ):
+        write_repodata(subdir_dir, repodata)
+    return added, removed
+
+
+def iter_subdirs(channel_dir):
+    """
+    Iterate over subdirectories of a channel (noarch is always included)
+    """
+    channel_dir = Path(channel_dir)
+    yield channel_dir / "noarch"
+    for i in sorted(channel_dir.iterdir()):
+        if i.name != "noarch" and i.is_dir() and subdir_re.match(i.name):
+            yield i
+
+
+def index_channel(channel_dir, force=False, subdirs=None):
+    """
+    Incrementally update the index of a channel. If subdirs is given, only
+    these subdirectories are indexed. If force is True, all archives are
+    read and repodata.json files are fully rebuilt. Return a dictionary
+    whose keys are subdir names and values are (added, removed) tuples.
+    """
+    channel_dir = Path(channel_dir)
+    if subdirs is None:
+        subdirs = iter_subdirs(channel_dir)
+    else:
+        subdirs = [channel_dir / i for i in subdirs]
+    result = {}
+    for subdir in subdirs:
+        subdir.mkdir(exist_ok=True)
+        result[subdir.name] = index_subdir(subdir, force=force)
+    return result
+
+
+def add_packages(channel_dir, build_dir):
+    """
+    Move the .conda archives created by a build in subdirectories of
+    build_dir (e.g. linux-64) to a channel and index the modified subdirs.
+    Concurrent callers adding packages to the same channel must hold a
+    common lock. Return the paths of added files relative to channel_dir.
+    """
+    channel_dir = Path(channel_dir)
+    files = []
+    for file in Path(build_dir).glob("*/*.conda"):
+        (channel_dir / file.parent.name).mkdir(exist_ok=True)
+        dest = channel_dir / file.parent.name / file.name
+        file.rename(dest)
+        # Make sure the indexer sees the file as newer than repodata.json
+        os.utime(dest)
+        files.append(f"{file.parent.name}/{file.name}")
+    index_channel(channel_dir, subdirs={i.split("/")[0] for i in files})
+    return files
@@ -0,0 +1,42 @@
+import json
+import os
+from pathlib import Path
+import tempfile
+
+"""
+On-disk caches stored as JSON files in the user cache directory. They are
+only an optimization: a missing or invalid cache file is read as an empty
+cache and write errors are ignored.
+"""
+
+
+def user_cache_dir():
+    """
+    Return the directory where neuro-forge stores its cache files
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(cache_home) / "neuro-forge"
+
+
+def read_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(cache_file, cache):
+    """
+    Atomically write a cache file. Failures are ignored since the cache is
+    only an optimization.
+    """
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=cache_file.parent, prefix=f".{cache_file.name}", delete=False
+        ) as f:
+            json.dump(cache, f)
+        os.replace(f.name, cache_file)
+    except OSError:
+        pass
@@ -0,0 +1,92 @@
+import functools
+import hashlib
+import json
+import os
+import subprocess
+
+from .catalog import catalog
+from .index import write_atomic
+
+"""
+Build manifest stored in a channel directory. For each recipe, it records a
+fingerprint of all the inputs of the build (recipe directory content,
+channels, variants and rattler-build version) as well as the package files
+that were created. It allows to rebuild only the recipes that changed since
+their last build.
+"""
+
+
+def manifest_file(channel_dir):
+    return channel_dir / ".neuro-forge" / "build.json"
+
+
+def read_manifest(channel_dir):
+    """
+    Return the build manifest of a channel directory (an empty dict if
+    it does not exist)
+    """
+    file = manifest_file(channel_dir)
+    if file.exists():
+        with open(file) as f:
+            return json.load(f)
+    return {}
+
+
+def write_manifest(channel_dir, manifest):
+    """
+    Atomically replace the build manifest of a channel directory
+    """
+    file = manifest_file(channel_dir)
+    file.parent.mkdir(exist_ok=True)
+    write_atomic(file, json.dumps(manifest, indent=4, sort_keys=True))
+
+
+def recipe_channels(recipe_dir):
+    """
+    Return the channels used to build a recipe. They can be customized in
+    a neuro-forge.yaml file located in the recipe directory.
+    """
+    return catalog([recipe_dir.parent])[recipe_dir.name]["channels"]
+
+
+@functools.lru_cache(maxsize=None)
+def rattler_build_version():
+    return subprocess.check_output(["rattler-build", "--version"], text=True).strip()
+
+
+def recipe_fingerprint(recipe_dir):
+    """
+    Return a hash of everything that can change the result of a recipe
+    build: content of all files in the recipe directory (including
+    recipe.yaml, variants.yaml, scripts and patches), channels and
+    rattler-build version.
+    """
+    h = hashlib.sha256()
+    h.update(rattler_build_version().encode())
+    h.update(b"\0")
+    h.update(json.dumps(recipe_channels(recipe_dir)).encode())
+    for root, dirs, files in os.walk(recipe_dir):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            h.update(b"\0")
+            h.update(os.path.relpath(path, recipe_dir).encode())
+            h.update(b"\0")
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def is_up_to_date(channel_dir, manifest, package, fingerprint):
+    """
+    Return True if the manifest contains a build of package made with the
+    given fingerprint and all the files of this build are still in the channel.
+    """
+    entry = manifest.get(package)
+    return bool(
+        entry
+        and entry.get("fingerprint") == fingerprint
+        and entry.get("files")
+        and all((channel_dir / i).exists() for i in entry["files"])
+    )
@@ -0,0 +1,254 @@
+import json
+import os
+from pathlib import Path
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+
+"""
+Transports used to publish a channel to a remote directory. A transport
+can run shell scripts next to the remote directory and upload a list of
+files. The same publication code is used whether the remote directory is
+on a web server (SSHTransport) or on a local file system (LocalTransport).
+The remote directory contains a manifest (.neuro-forge/manifest.json)
+giving the size and sha256 of all published files. It is used to transfer
+only new or modified files. Each publication creates a new generation of
+the remote directory, the published path being a symbolic link to the
+current generation.
+"""
+
+manifest_path = ".neuro-forge/manifest.json"
+default_retention = 3
+
+
+class Transport:
+    """
+    Base class for publication transports
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def run(self, script, capture=False):
+        """
+        Execute a bash script where the remote directory is accessible and
+        return its standard output if capture is True.
+        """
+        raise NotImplementedError()
+
+    def upload(self, local_dir, paths, remote_dir):
+        """
+        Copy files given by their path relative to local_dir in remote_dir.
+        Existing files are replaced and never modified in place (they can be
+        hard links shared with the published channel).
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def read_manifest(self):
+        """
+        Return the manifest of the published channel (an empty dict if it
+        does not exist)
+        """
+        content = self.run(
+            f"cat {shlex.quote(f'{self.directory}/{manifest_path}')} "
+            "2>/dev/null || true",
+            capture=True,
+        )
+        return json.loads(content) if content.strip() else {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LocalTransport(Transport):
+    """
+    Transport to a directory on a local (or mounted) file system
+    """
+
+    def __str__(self):
+        return self.directory
+
+    def run(self, script, capture=False):
+        p = subprocess.run(
+            ["bash"],
+            input=script.encode(),
+            check=True,
+            stdout=(subprocess.PIPE if capture else None),
+        )
+        if capture:
+            return p.stdout.decode()
+
+    def upload(self, local_dir, paths, remote_dir):
+        for path in paths:
+            dest = Path(remote_dir) / path
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmp = dest.parent / f".{dest.name}.tmp"
+            shutil.copy2(Path(local_dir) / path, tmp)
+            os.replace(tmp, dest)
+
+
+class SSHTransport(Transport):
+    """
+    Transport to a directory on a server accessible via ssh. All commands
+    share a single ssh connection.
+    """
+
+    def __init__(self, destination, directory):
+        super().__init__(directory)
+        self.destination = destination
+        self.control_dir = tempfile.mkdtemp(prefix="neuro-forge-ssh-")
+        self.ssh_options = [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_dir}/%C",
+            "-o",
+            "ControlPersist=600",
+        ]
+
+    def __str__(self):
+        return f"{self.destination}:{self.directory}"
+
+    def run(self, script, capture=False):
+        p = subprocess.run(
+            ["ssh"] + self.ssh_options + [self.destination, "/usr/bin/bash"],
+            input=script.encode(),
+            check=True,
+            stdout=(subprocess.PIPE if capture else None),
+        )
+        if capture:
+            return p.stdout.decode()
+
+    def upload(self, local_dir, paths, remote_dir):
+        command = [
+            "rsync",
+            "--files-from=-",
+            "--no-perms",
+            "--times",
+            "--no-owner",
+            "--no-group",
+            "-e",
+            " ".join(["ssh"] + self.ssh_options),
+            str(local_dir) + "/",
+            f"{self.destination}:{remote_dir}/",
+        ]
+        print(" ".join(f"'{i}'" for i in command))
+        subprocess.run(
+            command, input="".join(f"{i}\n" for i in paths).encode(), check=True
+        )
+
+    def close(self):
+        subprocess.run(
+            ["ssh"] + self.ssh_options + ["-O", "exit", self.destination],
+            stderr=subprocess.DEVNULL,
+        )
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+def transport_for(info):
+    """
+    Return the transport corresponding to a publication entry of
+    neuro-forge.json or None if the channel is not published elsewhere.
+    """
+    if "ssh" in info:
+        return SSHTransport(info["ssh"]["destination"], info["ssh"]["directory"])
+    if "local" in info:
+        return LocalTransport(info["local"]["directory"])
+    return None
+
+
+def files_manifest(files):
+    """
+    Convert files dictionary from channel state to publication manifest
+    """
+    return {
+        path: {"size": info["size"], "sha256": info["sha256"]}
+        for path, info in files.items()
+    }
+
+
+def publish_files(transport, channel_dir, files, retention=default_retention):
+    """
+    Publish channel files (as returned by state.scan_channel) using a
+    transport. A new immutable generation directory is created next to the
+    published directory (in {directory}-generations). It contains hard links
+    to unchanged files of the current generation and only new or modified
+    files (according to the remote manifest) are transferred (as well as
+    repodata files). The published directory is a symbolic link that is
+    atomically switched to the new generation. Only the retention most
+    recent generations are kept. Return the list of transferred paths.
+    """
+    directory = transport.directory.rstrip("/")
+    generations = f"{directory}-generations"
+    now = time.time()
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    stamp += f".{int(now * 1e6) % 1000000:06d}"
+    manifest = files_manifest(files)
+    remote_manifest = transport.read_manifest()
+    to_upload = sorted(
+        path
+        for path, info in manifest.items()
+        if remote_manifest.get(path, {}).get("sha256") != info["sha256"]
+        or os.path.basename(path).startswith("repodata")
+    )
+    to_link = sorted(set(manifest) - set(to_upload))
+    to_remove = sorted(set(remote_manifest) - set(manifest))
+    print(
+        f"{transport}: {len(to_upload)} files to send, {len(to_link)} unchanged, "
+        f"{len(to_remove)} removed"
+    )
+
+    # Create the new generation. Its name starts with the date (to sort
+    # generations) and ends with a unique suffix so that simultaneous
+    # publications never use the same directory.
+    q = shlex.quote
+    generation = transport.run(
+        f"set -e\nmkdir -p {q(generations)}\n"
+        f"mktemp -d {q(f'{generations}/{stamp}-')}XXXXXX\n",
+        capture=True,
+    ).strip()
+
+    # Add hard links to unchanged files
+    if to_link:
+        script = [
+            "set -e",
+            f"cd {q(directory)}/",
+            f"xargs -d '\\n' cp -al --parents -t {q(generation)} << 'EOF'",
+        ]
+        transport.run("\n".join(script + to_link + ["EOF"]) + "\n")
+
+    # Send new and modified files as well as the new manifest
+    with tempfile.TemporaryDirectory() as tmp:
+        (Path(tmp) / manifest_path).parent.mkdir(parents=True)
+        with open(Path(tmp) / manifest_path, "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        transport.upload(channel_dir, to_upload, generation)
+        transport.upload(tmp, [manifest_path], generation)
+
+    # Atomically switch the published channel to the new generation. A
+    # published directory that is not a symbolic link (i.e. created before
+    # the use of generations) is first moved in generations directory.
+    # Then remove old generations.
+    transport.run(
+        f"""set -xe
+        chmod -R a+rX {q(generation)}
+        if [ -d {q(directory)} ] && [ ! -L {q(directory)} ]; then
+            mv {q(directory)} {q(generations)}/00000000-000000
+            ln -s {q(generations)}/00000000-000000 {q(directory)}
+        fi
+        ln -sfn {q(generation)} {q(directory)}.new
+        mv -T {q(directory)}.new {q(directory)}
+        ls -1 {q(generations)} | sort -r | tail -n +{max(retention, 1) + 1} | while read g; do
+            rm -Rf {q(generations)}/"$g"
+        done
+        """
+    )
+    return to_upload
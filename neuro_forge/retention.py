@@ -0,0 +1,118 @@
+import fnmatch
+import json
+from pathlib import Path
+import re
+import time
+
+from .index import iter_subdirs, read_repodata
+
+"""
+Retention policy for channels. It selects the package files that can be
+removed from a channel according to per-package rules:
+    - keep: number of builds kept for each package version and build
+      string (without build number).
+    - dev_max_age: number of days after which packages of development
+      environments (soma-env 0.x and packages depending on it) are removed.
+Packages referenced in a published soma-env-*.json release history are
+always kept.
+"""
+
+default_rules = {"keep": 3, "dev_max_age": None}
+
+
+def package_rules(rules, name):
+    """
+    Return the rules to apply to a package. Rules given for package names
+    (or fnmatch patterns) in rules["packages"] override global rules.
+    """
+    result = default_rules.copy()
+    result.update((k, v) for k, v in rules.items() if k != "packages")
+    for pattern, overrides in rules.get("packages", {}).items():
+        if fnmatch.fnmatchcase(name, pattern):
+            result.update(overrides)
+    return result
+
+
+def protected_builds(channel_dir):
+    """
+    Return the set of (name, version, build_string) referenced by the
+    release histories (soma-env-*.json) published in channel_dir. For
+    soma-env package, build_string is None.
+    """
+    result = set()
+    for history_file in Path(channel_dir).glob("soma-env-*.json"):
+        with open(history_file) as f:
+            history = json.load(f)
+        for package, info in history.items():
+            if package == "environment_version":
+                result.add(("soma-env", info, None))
+            elif isinstance(info, dict) and "version" in info:
+                result.add((package, info["version"], info.get("build_string")))
+    return result
+
+
+def is_protected(record, protected):
+    name, version = record["name"], record["version"]
+    return (name, version, record["build"]) in protected or (
+        (name, version, None) in protected
+    )
+
+
+def is_development(record):
+    """
+    A package belongs to a development environment if it is a soma-env 0.x
+    package or if it depends on such a package.
+    """
+    if record["name"] == "soma-env":
+        return record["version"].startswith("0.")
+    for depend in record.get("depends", []):
+        match = re.match(r"^soma-env\s+[>=]*\s*0\.", depend)
+        if match:
+            return True
+    return False
+
+
+def select_obsolete(channel_dir, rules, now=None):
+    """
+    Iterate over (subdir, file name, record, reason) for each package file
+    of channel_dir that can be removed according to rules.
+    """
+    now = time.time() if now is None else now
+    protected = protected_builds(channel_dir)
+    for subdir in iter_subdirs(channel_dir):
+        repodata = read_repodata(subdir)
+        if not repodata:
+            continue
+        groups = {}
+        for key in ("packages", "packages.conda"):
+            for file, record in repodata.get(key, {}).items():
+                group = (
+                    record["name"],
+                    record["version"],
+                    re.sub(r"_\d+$", "", record["build"]),
+                )
+                groups.setdefault(group, []).append((file, record))
+        for (name, version, build), records in sorted(groups.items()):
+            r = package_rules(rules, name)
+            records.sort(
+                key=lambda i: (i[1].get("build_number", 0), i[1].get("timestamp", 0)),
+                reverse=True,
+            )
+            for index, (file, record) in enumerate(records):
+                if is_protected(record, protected):
+                    continue
+                if r["keep"] is not None and index >= r["keep"]:
+                    yield (subdir.name, file, record, f"more than {r['keep']} builds")
+                    continue
+                age = (now - record.get("timestamp", now * 1000) / 1000) / 86400
+                if (
+                    r["dev_max_age"] is not None
+                    and age > r["dev_max_age"]
+                    and is_development(record)
+                ):
+                    yield (
+                        subdir.name,
+                        file,
+                        record,
+                        f"development package older than {r['dev_max_age']} days",
+                    )
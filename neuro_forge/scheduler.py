@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import sys
+import traceback
+
+"""
+Execution of jobs organized in a dependency graph. A job is started as soon
+as all the jobs it depends on are successful. A failed job only cancels
+the jobs that depend on it (directly or not).
+"""
+
+
+def check_cycles(dependencies):
+    """
+    Raise a ValueError if dependencies (a dictionary whose keys are job
+    names and values are the names of the jobs they depend on) contains a
+    cycle. Dependencies that are not keys of the dictionary are ignored.
+    """
+    remaining = {
+        name: {d for d in deps if d in dependencies}
+        for name, deps in dependencies.items()
+    }
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(
+                f"Dependency cycle between {', '.join(sorted(remaining))}"
+            )
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+def run_jobs(dependencies, run, jobs=1):
+    """
+    Call run(name) for each job name in dependencies, running at most
+    jobs calls at the same time. run must return True on success. Return a
+    dictionary whose keys are job names and values are either "success",
+    "failure" or "cancelled".
+    """
+    check_cycles(dependencies)
+    dependencies = {
+        name: {d for d in deps if d in dependencies}
+        for name, deps in dependencies.items()
+    }
+    status = {}
+    pending = set(dependencies)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        while pending or running:
+            # Propagate failures to all dependent jobs
+            cancelled = True
+            while cancelled:
+                cancelled = False
+                for name in sorted(pending):
+                    if any(
+                        status.get(d) in ("failure", "cancelled")
+                        for d in dependencies[name]
+                    ):
+                        print(f"Cancel {name} because a dependency failed")
+                        status[name] = "cancelled"
+                        pending.remove(name)
+                        cancelled = True
+
+            # Start ready jobs
+            for name in sorted(pending):
+                if len(running) >= jobs:
+                    break
+                if all(status.get(d) == "success" for d in dependencies[name]):
+                    running[executor.submit(run, name)] = name
+                    pending.remove(name)
+
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    success = future.result()
+                except Exception:
+                    traceback.print_exc()
+                    success = False
+                status[name] = "success" if success else "failure"
+    return status
+
+
+def print_summary(status, file=sys.stdout):
+    """
+    Print the status of all jobs returned by run_jobs()
+    """
+    print("#----------------- summary ------------------------------", file=file)
+    for name, s in sorted(status.items()):
+        print(f"{s:>10} {name}", file=file)
+    print("#--------------------------------------------------------", file=file)
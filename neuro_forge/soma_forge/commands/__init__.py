@@ -14,7 +14,9 @@ def cli():
 
 
 from . import apply_plan
+from . import check_environments
 from . import check_merge
 from . import graphviz
 from . import init
 from . import packaging_plan
+from . import sync
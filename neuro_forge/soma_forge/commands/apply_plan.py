@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import git
 import json
 import os
@@ -6,12 +7,16 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
+import time
 import types
 import toml
 import yaml
 
 import click
 from . import cli
+from ...index import add_packages, index_channel
+from ...scheduler import print_summary, run_jobs
 
 
 def check_build_status(context):
@@ -75,13 +80,126 @@ def rebuild(context):
     )
 
 
+# Bash function making a staged prefix relocatable: RPATH entries of ELF
+# files and symbolic links pointing inside the prefix are made relative
+# ($ORIGIN based for RPATHs). rattler-build only relocates paths that point
+# inside the host prefix of the build.
+relocate_stage_script = r"""
+relocate_stage() {
+    local stage="$1" file rpath entry new
+    find "$stage" -type l | while read -r file; do
+        entry=$(readlink "$file")
+        case "$entry" in "$stage"|"$stage"/*)
+            ln -sfn "$(realpath -m --relative-to="$(dirname "$file")" "$entry")" "$file"
+        esac
+    done
+    find "$stage" -type f | while read -r file; do
+        [ "$(head -c 4 "$file")" = $'\x7fELF' ] || continue
+        rpath=$(patchelf --print-rpath "$file" 2>/dev/null) || continue
+        new=""
+        IFS=: read -ra entries <<< "$rpath"
+        for entry in "${entries[@]}"; do
+            case "$entry" in "$stage"|"$stage"/*)
+                entry='$ORIGIN/'$(realpath -m --relative-to="$(dirname "$file")" "$entry")
+            esac
+            new="${new:+$new:}$entry"
+        done
+        [ "$new" = "$rpath" ] || patchelf --set-rpath "$new" "$file"
+    done
+}
+"""
+
+
+def stage_component_files(prefix):
+    """
+    Return a (files, errors) tuple for a relocated stage prefix. files is
+    the sorted list of the files and links of the prefix (relative to it).
+    errors lists binary files and symbolic links still referring to the
+    prefix (text files are fixed by package build scripts).
+    """
+    prefix = str(prefix)
+    files = []
+    errors = []
+    for root, dirs, names in os.walk(prefix):
+        for name in names + [i for i in dirs if os.path.islink(os.path.join(root, i))]:
+            path = os.path.join(root, name)
+            files.append(os.path.relpath(path, prefix))
+            if os.path.islink(path):
+                target = os.readlink(path)
+                if target == prefix or target.startswith(f"{prefix}/"):
+                    errors.append(f"{path}: link to {target}")
+                continue
+            with open(path, "rb") as f:
+                content = f.read()
+            if prefix.encode() in content and b"\0" in content:
+                errors.append(f"{path}: binary file containing {prefix}")
+    return sorted(files), errors
+
+
+def stage_components(context, components):
+    """
+    Install all components once in a staging directory (one prefix per
+    component in plan/stage) with a single pixi call. The staged prefixes
+    are made relocatable and package builds copy their files from them.
+    The files installed by each component are listed in
+    plan/stage/manifest.json. A ValueError is raised if a staged file
+    cannot be relocated.
+    """
+    stage_dir = context.pixi_root / "plan" / "stage"
+    for component in components:
+        if (stage_dir / component).exists():
+            shutil.rmtree(stage_dir / component)
+    stage_dir.mkdir(exist_ok=True)
+    script = [relocate_stage_script, 'cd "$CASA_BUILD"']
+    for component in components:
+        targets = " ".join(
+            f"install-{component}{i}"
+            for i in ("", "-dev", "-usrdoc", "-devdoc", "-test")
+        )
+        script.append(
+            f"BRAINVISA_INSTALL_PREFIX='{stage_dir / component}' make {targets}"
+        )
+        script.append(f"relocate_stage '{stage_dir / component}'")
+    subprocess.check_call(
+        [
+            "pixi",
+            "run",
+            "--manifest-path",
+            str(context.pixi_root / "pixi.toml"),
+            "bash",
+            "-e",
+            "-c",
+            "\n".join(script),
+        ]
+    )
+    manifest = {}
+    errors = []
+    for component in components:
+        manifest[component], component_errors = stage_component_files(
+            stage_dir / component
+        )
+        errors.extend(component_errors)
+    with open(stage_dir / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=4)
+    if errors:
+        for error in errors:
+            print(f"ERROR: {error}", file=sys.stderr)
+        raise ValueError(
+            f"{len(errors)} staged files refer to the stage directory and "
+            "cannot be relocated"
+        )
+
+
 def create_package(context, package, test):
     recipe_dir = context.pixi_root / "plan" / "recipes" / package
     print(f"creating package {package} using test={test} from {recipe_dir}")
     output = context.pixi_root / "plan" / "packages"
-    build_dir = output / "bld" / f"rattler-build_{package}"
+    # Each build has its own output directory, created packages are moved
+    # in output afterward.
+    build_dir = output / "bld" / "jobs" / package
     if build_dir.exists():
         shutil.rmtree(build_dir)
+    build_dir.mkdir(parents=True)
     command = [
         "rattler-build",
         "build",
@@ -90,7 +208,7 @@ def create_package(context, package, test):
         "-r",
         recipe_dir,
         "--output-dir",
-        str(output),
+        str(build_dir),
     ]
     if not test:
         command.append("--no-test")
@@ -99,19 +217,122 @@ def create_package(context, package, test):
     channels = pixi_toml["project"]["channels"]
     for i in channels + [f"file://{output}"]:
         command.extend(["-c", i])
-    try:
-        subprocess.check_call(command)
-    except subprocess.CalledProcessError:
-        print(
-            "ERROR command failed:",
-            " ".join(f"'{i}'" for i in command),
-            file=sys.stderr,
-            flush=True,
+    log_file = output / "bld" / "logs" / f"{package}.log"
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_file, "w") as log:
+        if context.jobs > 1:
+            print(f"Building {package} (log in {log_file})", flush=True)
+            stdout = log
+        else:
+            stdout = None
+        try:
+            subprocess.check_call(command, stdout=stdout, stderr=stdout)
+        except subprocess.CalledProcessError:
+            print(
+                "ERROR command failed:",
+                " ".join(f"'{i}'" for i in command),
+                file=sys.stderr,
+                flush=True,
+            )
+            raise
+
+    # Move created packages in the local channel and make them available to
+    # other builds
+    with context.index_lock:
+        add_packages(output, build_dir)
+    shutil.rmtree(build_dir)
+
+
+def test_script(test):
+    script = test["script"]
+    if isinstance(script, list):
+        script = "\n".join(script)
+    elif isinstance(script, dict):
+        script = "\n".join(script.get("content", []))
+    return script
+
+
+def test_packages(context, packages):
+    """
+    Test packages built without tests. A single environment containing all
+    packages (and the requirements of their tests) is created from the
+    local channel and the test scripts of all recipes are run in parallel.
+    """
+    test_dir = context.pixi_root / "plan" / "test"
+    if test_dir.exists():
+        shutil.rmtree(test_dir)
+    (test_dir / "logs").mkdir(parents=True)
+    with open(context.pixi_root / "pixi.toml") as f:
+        pixi_toml = toml.load(f)
+    output = context.pixi_root / "plan" / "packages"
+
+    dependencies = {}
+    scripts = {}
+    for package in packages:
+        with open(
+            context.pixi_root / "plan" / "recipes" / package / "recipe.yaml"
+        ) as f:
+            recipe = yaml.safe_load(f)
+        dependencies[package] = f"=={recipe['package']['version']}"
+        for test in recipe.get("tests", []):
+            if "script" not in test:
+                continue
+            scripts.setdefault(package, []).append(test_script(test))
+            for requirement in test.get("requirements", {}).get("run", []):
+                name, constraint = (requirement.split(None, 1) + ["*"])[:2]
+                dependencies.setdefault(name, constraint)
+    with open(test_dir / "pixi.toml", "w") as f:
+        toml.dump(
+            {
+                "project": {
+                    "name": "soma-forge-test",
+                    "channels": [f"file://{output}"]
+                    + pixi_toml["project"]["channels"],
+                    "platforms": pixi_toml["project"].get("platforms", ["linux-64"]),
+                },
+                "dependencies": dependencies,
+            },
+            f,
         )
-        raise
-    with open(context.pixi_root / "plan" / "recipes" / package / "recipe.yaml") as f:
-        recipe = yaml.safe_load(f)
-    version = recipe["package"]["version"]
+    print(f"Creating test environment for {len(packages)} packages in {test_dir}")
+    subprocess.check_call(
+        ["pixi", "install", "--manifest-path", str(test_dir / "pixi.toml")]
+    )
+
+    def run_tests(package):
+        log_file = test_dir / "logs" / f"{package}.log"
+        with open(log_file, "w") as log:
+            for script in scripts[package]:
+                returncode = subprocess.call(
+                    [
+                        "pixi",
+                        "run",
+                        "--manifest-path",
+                        str(test_dir / "pixi.toml"),
+                        "bash",
+                        "-e",
+                        "-c",
+                        script,
+                    ],
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    cwd=test_dir,
+                )
+                if returncode:
+                    return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=context.jobs) as executor:
+        results = dict(zip(scripts, executor.map(run_tests, scripts)))
+    for package in packages:
+        if package not in results:
+            print(f"{'no test':>10} {package}")
+        else:
+            result = "success" if results[package] else "failure"
+            print(f"{result:>10} {package} (log in {test_dir / 'logs' / package}.log)")
+    failed = [package for package, success in results.items() if not success]
+    if failed:
+        raise ValueError(f"Tests failed for: {', '.join(failed)}")
 
 
 def publish(
@@ -150,19 +371,23 @@ def publish(
             print(src, "->", dest)
             if not force and dest.exists():
                 raise ValueError(f"Destination file {dest} already exist")
-            shutil.copy2(src, dest)
+            # Replace the file (instead of modifying it in place) with a new
+            # modification time to have it indexed and published again.
+            tmp = dest.parent / f".{dest.name}.tmp"
+            shutil.copy(src, tmp)
+            os.replace(tmp, dest)
             copied.append(dest)
-        release_history_file = publication_dir / f"soma-forge-{environment}.json"
+        release_history_file = publication_dir / f"soma-env-{environment}.json"
         if release_history_file.exists():
             release_history_file_backup = (
-                publication_dir / f"soma-forge-{environment}.json.backup"
+                publication_dir / f"soma-env-{environment}.json.backup"
             )
             os.rename(release_history_file, release_history_file_backup)
         with open(release_history_file, "w") as f:
             copied.append(release_history_file)
             json.dump(release_history, f, indent=4)
         if index:
-            subprocess.check_call(["conda", "index", str(publication_dir)])
+            index_channel(publication_dir)
     except Exception:
         for f in copied:
             os.remove(f)
@@ -173,19 +398,136 @@ def publish(
         os.remove(release_history_file_backup)
 
 
+def read_journal(journal_file):
+    """
+    Replay the journal of a plan and return a dictionary whose keys are
+    action ids and values are the last record of this action. Invalid lines
+    (e.g. an incomplete line written during a crash) are ignored.
+    """
+    result = {}
+    if not journal_file.exists():
+        return result
+    with open(journal_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                result[str(record["action"])] = record
+            except (ValueError, TypeError, KeyError):
+                continue
+    return result
+
+
+def append_journal(journal_file, record):
+    """
+    Append a record to the journal of a plan. The record is written on disk
+    before returning. An incomplete last line left by a crash is removed
+    first, otherwise it would be merged with the new record.
+    """
+    with open(journal_file, "ab+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size:
+            f.seek(size - 1)
+            if f.read(1) != b"\n":
+                f.seek(0)
+                f.truncate(f.read().rfind(b"\n") + 1)
+        f.write((json.dumps(record) + "\n").encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def action_dependencies(actions):
+    """
+    Return a dictionary whose keys are action ids and values are the ids of
+    the actions they depend on. Actions without id (created by older
+    versions of packaging_plan) are identified by their index and depend
+    on the previous action.
+    """
+    result = {}
+    previous = None
+    for index, action in enumerate(actions):
+        if "id" in action:
+            action_id = action["id"]
+            result[action_id] = action.get("depends", [])
+        else:
+            action_id = str(index)
+            result[action_id] = [] if previous is None else [previous]
+        previous = action_id
+    return result
+
+
 @cli.command()
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="Maximum number of actions run simultaneously",
+)
 @click.argument("directory", type=click.Path())
-def apply_plan(directory):
+def apply_plan(directory, jobs):
     pixi_root = pathlib.Path(directory).absolute()
     with open(pixi_root / "plan" / "actions.yaml") as f:
         actions = yaml.safe_load(f)
+    dependencies = action_dependencies(actions)
+    actions = dict(zip(dependencies, actions))
+    # actions.yaml is never modified, the status of actions is recorded in
+    # an append-only journal
+    journal_file = pixi_root / "plan" / "journal.jsonl"
+    journal = read_journal(journal_file)
+    journal_lock = threading.Lock()
     context = types.SimpleNamespace()
     context.pixi_root = pixi_root
-    for action in actions:
-        if action.get("status") != "success":
+    context.jobs = jobs
+    context.index_lock = threading.Lock()
+
+    # Packages are built in a local channel that must exist from the start
+    packages_dir = pixi_root / "plan" / "packages"
+    packages_dir.mkdir(exist_ok=True)
+    index_channel(packages_dir)
+
+    def run(action_id):
+        action = actions[action_id]
+        if (
+            action.get("status") == "success"
+            or journal.get(action_id, {}).get("status") == "success"
+        ):
+            return True
+        record = {"action": action_id, "name": action["action"]}
+        start = time.time()
+        with journal_lock:
+            append_journal(journal_file, dict(record, event="start", time=start))
+        try:
             globals()[action["action"]](
                 context, *action.get("args", []), **action.get("kwargs", {})
             )
-            action["status"] = "success"
-            with open(pixi_root / "plan" / "actions.yaml", "w") as f:
-                yaml.safe_dump(actions, f)
+        except Exception as e:
+            with journal_lock:
+                append_journal(
+                    journal_file,
+                    dict(
+                        record,
+                        event="stop",
+                        start=start,
+                        time=time.time(),
+                        status="failure",
+                        error=f"{e.__class__.__name__}: {e}",
+                    ),
+                )
+            raise
+        with journal_lock:
+            append_journal(
+                journal_file,
+                dict(
+                    record,
+                    event="stop",
+                    start=start,
+                    time=time.time(),
+                    status="success",
+                ),
+            )
+        return True
+
+    status = run_jobs(dependencies, run, jobs=jobs)
+    if any(i != "success" for i in status.values()):
+        print_summary(status)
+        sys.exit(1)
@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import sys
+
+import click
+from rich.table import Table
+
+from . import cli, console
+from ..environments import component_source, environments_info, iter_environments
+from ..git import default_refs_ttl, remote_refs
+
+
+@cli.command()
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=8,
+    help="Maximum number of remote repositories queried simultaneously",
+)
+@click.option(
+    "--ttl",
+    type=float,
+    default=default_refs_ttl,
+    help="Time in seconds during which cached remote refs are reused "
+    "(0 to query all repositories)",
+)
+def check_environments(jobs, ttl):
+    """Check that the branch of every component of every environment exists"""
+    errors = []
+    sources = []
+    for environment in iter_environments():
+        components = environments_info()[environment].get("components", {})
+        for component, info in components.items():
+            if "url" not in info:
+                errors.append((environment, component, "", "no url defined"))
+                continue
+            try:
+                source = component_source(component, environment)
+            except ValueError as e:
+                errors.append((environment, component, "", str(e)))
+                continue
+            if source:
+                sources.append((environment, component) + source)
+
+    # Query each URL only once, even if it is used by several environments
+    def query(url):
+        try:
+            return remote_refs(url, ttl=ttl)
+        except subprocess.CalledProcessError as e:
+            return (e.stderr.strip().splitlines() or ["git ls-remote failed"])[0]
+
+    urls = sorted({i[2] for i in sources})
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        refs = dict(zip(urls, executor.map(query, urls)))
+
+    for environment, component, url, branch in sources:
+        if isinstance(refs[url], str):
+            errors.append((environment, component, url, refs[url]))
+        elif (
+            f"refs/heads/{branch}" not in refs[url]
+            and f"refs/tags/{branch}" not in refs[url]
+        ):
+            errors.append((environment, component, url, f"no branch {branch}"))
+
+    print(
+        f"Checked {len(sources)} component sources from {len(urls)} repositories"
+    )
+    if errors:
+        table = Table()
+        for column in ("environment", "component", "url", "error"):
+            table.add_column(column)
+        for error in errors:
+            table.add_row(*error)
+        console.print(table)
+        sys.exit(1)
@@ -1,34 +1,67 @@
-import git
-import pathlib
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys
 
 import click
 from . import cli
+from ..git import check_merge_needed, find_repositories
 
 
 @cli.command()
 @click.argument("src", type=click.Path())
 @click.option("--branch", type=str, default=None)
-def check_merge(src, branch):
-    stack = [pathlib.Path(src)]
-    while stack:
-        src = stack.pop()
-        if (src / ".git").exists():
-            repo = git.Repo(str(src))
-            branches = {i.name.rsplit("/", 1)[-1] for i in repo.remote().refs}
-            if branch is None:
-                if "master" in branches:
-                    branch = "master"
-                else:
-                    branch = "main"
-
-            repo.git.fetch()
-            non_merged = {
-                i.split(None, 1)[0]
-                for i in repo.git.branch("-r", "--no-merge").split("\n")
-                if i
-            }
-            if f"origin/{branch}" in non_merged:
-                print(f"git -C '{src}' merge --no-edit origin/{branch}")
-                print(f"git -C '{src}' push")
-        else:
-            stack.extend(i for i in src.iterdir() if i.is_dir())
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=8,
+    help="Maximum number of repositories fetched simultaneously",
+)
+@click.option(
+    "--timeout",
+    type=float,
+    default=300,
+    help="Maximum time in seconds allowed to fetch a repository",
+)
+@click.option(
+    "--max-depth",
+    type=int,
+    default=3,
+    help="Maximum depth of directories explored to find repositories",
+)
+@click.option(
+    "--ignore",
+    type=str,
+    multiple=True,
+    help="fnmatch pattern of directory names that are not explored",
+)
+@click.option(
+    "--report",
+    type=click.Path(),
+    default=None,
+    help="Write a JSON report in this file (- for standard output)",
+)
+def check_merge(src, branch, jobs, timeout, max_depth, ignore, report):
+    """Check if remote branches must be merged in source repositories"""
+    repositories = list(find_repositories(src, max_depth=max_depth, ignore=ignore))
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        reports = list(
+            executor.map(
+                lambda i: check_merge_needed(i, branch=branch, timeout=timeout),
+                repositories,
+            )
+        )
+    for r in reports:
+        if report != "-":
+            for command in r["commands"]:
+                print(command)
+        if r["status"] == "timeout":
+            print(f"# fetch of {r['path']} timed out", file=sys.stderr)
+        elif r["status"] == "error":
+            print(f"# cannot check {r['path']}: {r['error']}", file=sys.stderr)
+    if report == "-":
+        json.dump(reports, sys.stdout, indent=4)
+        print()
+    elif report:
+        with open(report, "w") as f:
+            json.dump(reports, f, indent=4)
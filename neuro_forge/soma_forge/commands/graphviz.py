@@ -3,7 +3,7 @@ import fnmatch
 import re
 
 from . import cli
-from ..recipes import sorted_recipies
+from ..recipes import recipe_graph
 from ... import find_neuro_forge_packages
 
 
@@ -20,35 +20,28 @@ def graphviz(packages, conda_forge):
     linked = set()
     print("digraph {")
     print("  node [shape=box, color=black, style=filled]")
-    recipes ={recipe["package"]["name"]: recipe for recipe in sorted_recipies()}
-    selected_recipes = set()
-    stack = [i for i in recipes if selector.match(i)]
-    while stack:
-        package = stack.pop(0)
-        selected_recipes.add(package)
-        recipe = recipes[package]
-        stack.extend(
-            dependency
-            for dependency in recipe["soma-forge"].get("internal-dependencies", [])
-            if dependency not in selected_recipes
-        )
+    graph = recipe_graph()
+    selected = 0
+    for node in graph:
+        if selector.match(node.name):
+            selected |= node.bit | node.closure
 
     all_neuro_forge_packages = set(find_neuro_forge_packages())
-    for package in selected_recipes:
-        recipe = recipes[package]
-        if recipe["soma-forge"]["type"] == "interpreted":
+    for node in graph.nodes(selected):
+        package = node.name
+        if node.type == "interpreted":
             print(f'  "{package}" [fillcolor="aquamarine2"]')
-        elif recipe["soma-forge"]["type"] == "compiled":
+        elif node.type == "compiled":
             print(f'  "{package}" [fillcolor="darkgreen",fontcolor=white]')
-        elif recipe["soma-forge"]["type"] == "virtual":
+        elif node.type == "virtual":
             print(f'  "{package}" [fillcolor="powderblue"]')
         else:
             print(f'  "{package}" [fillcolor="bisque"]')
-        for dependency in recipe["soma-forge"].get("internal-dependencies", []):
+        for dependency in node.dependencies:
             if (package, dependency) not in linked:
                 print(f'  "{package}" -> "{dependency}"')
                 linked.add((package, dependency))
-        for dependency in recipe.get("requirements", {}).get("run", []):
+        for dependency in node.recipe.get("requirements", {}).get("run", ()):
             if dependency in all_neuro_forge_packages:
                 neuro_forge_packages.add(dependency)
                 print(f'  "{package}" -> "{dependency}"')
@@ -14,6 +14,7 @@ from . import cli, console
 from ..pixi import read_pixi_config, write_pixi_config
 from ..recipes import selected_recipes
 from ..environments import component_source, get_environment_info
+from ..git import mirror_path, update_mirror
 
 default_python = "3.11"
 bv_maker_cfg_template = """[ source $CASA_SRC ]
@@ -46,10 +47,17 @@ bv_maker_cfg_template = """[ source $CASA_SRC ]
     help=f"Python version (default=config file value or {default_python})",
 )
 @click.option("--force", is_flag=True)
+@click.option(
+    "--mirror-dir",
+    type=click.Path(),
+    envvar="SOMA_FORGE_MIRROR_DIR",
+    default=None,
+    help="Directory of bare git mirrors shared between workspaces",
+)
 @click.argument("directory", type=click.Path())
 @click.argument("environment", type=str)
 @click.argument("packages", type=str, nargs=-1)
-def init(directory, environment, packages, python, force):
+def init(directory, environment, packages, python, force, mirror_dir):
     """Create or reconfigure a full BrainVISA development directory"""
     environment_info = get_environment_info(environment)
     neuro_forge_url = "https://brainvisa.info/neuro-forge"
@@ -250,7 +258,15 @@ def init(directory, environment, packages, python, force):
     # Download brainvisa-cmake sources
     if not (pixi_root / "src" / "brainvisa-cmake").exists():
         (pixi_root / "src").mkdir(exist_ok=True)
-        git.Repo.clone_from(
-            "https://github.com/brainvisa/brainvisa-cmake",
-            str(pixi_root / "src" / "brainvisa-cmake"),
-        )
+        url = "https://github.com/brainvisa/brainvisa-cmake"
+        if mirror_dir:
+            report = update_mirror(mirror_dir, url)
+            if report["status"] != "ok":
+                raise RuntimeError(f"Cannot update mirror of {url}")
+            git.Repo.clone_from(
+                url,
+                str(pixi_root / "src" / "brainvisa-cmake"),
+                reference=str(mirror_path(mirror_dir, url)),
+            )
+        else:
+            git.Repo.clone_from(url, str(pixi_root / "src" / "brainvisa-cmake"))
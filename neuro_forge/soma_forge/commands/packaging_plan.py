@@ -1,5 +1,5 @@
 import fnmatch
-import git
+import hashlib
 import itertools
 import json
 import os
@@ -10,13 +10,16 @@ import shlex
 import shutil
 import subprocess
 import sys
-import toml
+import time
 import yaml
 
 import click
 
 from . import cli
-from ..recipes import sorted_recipies
+from ...json_cache import read_cache, write_cache
+from ..git import scan_repositories
+from ..recipes import rebuild_impact, recipe_graph, sorted_recipies
+from ..versions import component_version, set_component_version
 
 neuro_forge_url = "https://brainvisa.info/neuro-forge"
 
@@ -37,63 +40,76 @@ def forged_packages(pixi_root, name_re):
                 yield package_info
 
 
-def get_test_commands(log_lines=None):
+def ctest_files(build_dir):
+    """
+    Return a dictionary whose keys are the CTestTestfile.cmake files of a
+    build directory and values are their modification time.
+    """
+    result = {}
+    for root, dirs, files in os.walk(build_dir):
+        if "CTestTestfile.cmake" in files:
+            path = os.path.join(root, "CTestTestfile.cmake")
+            result[path] = os.stat(path).st_mtime_ns
+    return result
+
+
+def cached_ctest_files_valid(files):
+    """
+    Check that CTestTestfile.cmake files recorded in a cache did not change.
+    New test directories are also detected since CMake rewrites the
+    CTestTestfile.cmake of the parent directory when they are added.
+    """
+    for path, mtime in files.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def get_test_commands(log_lines=None, build_dir=None):
     """
     Use ctest to extract command lines to execute in order to run tests.
     This function returns a dictionary whose keys are name of a test (i.e.
     'axon', 'soma', etc.) and values are a list of commands to run to perform
-    the test.
+    the test. Tests are listed with a single call to
+    ``ctest --show-only=json-v1`` whose result is cached in the build
+    directory until a CTestTestfile.cmake is modified.
     """
-    cmd = ["ctest", "--print-labels"]
-    # universal_newlines is the old name to request text-mode (text=True)
-    o = subprocess.check_output(cmd, bufsize=-1, universal_newlines=True)
-    labels = [i.strip() for i in o.split("\n")[2:] if i.strip()]
+    if build_dir is None:
+        build_dir = os.environ.get("CASA_BUILD", os.getcwd())
+    build_dir = pathlib.Path(build_dir)
+    cache_file = build_dir / "ctest-commands.json"
+    cache = read_cache(cache_file)
+    if cache.get("files") and cached_ctest_files_valid(cache["files"]):
+        if log_lines is not None:
+            log_lines += [f"Using test commands cached in {cache_file}", "\n"]
+        return cache["tests"]
+
+    files = ctest_files(build_dir)
+    cmd = ["ctest", "--show-only=json-v1"]
+    p = subprocess.run(
+        cmd,
+        cwd=build_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
     if log_lines is not None:
-        log_lines += ["$ " + " ".join(shlex.quote(arg) for arg in cmd), o, "\n"]
+        log_lines += ["$ " + " ".join(shlex.quote(arg) for arg in cmd), p.stdout, "\n"]
+    if p.returncode != 0:
+        sys.stderr.write(p.stderr)
+        raise RuntimeError("ctest failed with the above error")
     tests = {}
-    for label in labels:
-        cmd = ["ctest", "-V", "-L", f"^{label}$"]
-        env = os.environ.copy()
-        env["BRAINVISA_TEST_REMOTE_COMMAND"] = "echo"
-        p = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=-1,
-            universal_newlines=True,
-            env=env,
-        )
-        o, stderr = p.communicate()
-        if log_lines is not None:
-            log_lines += ["$ " + " ".join(shlex.quote(arg) for arg in cmd), o, "\n"]
-        if p.returncode != 0:
-            # We want to hide stderr unless ctest returns a nonzero exit
-            # code. In the case of test filtering where no tests are
-            # matched (e.g. with ctest_options=['-R', 'dummyfilter']), the
-            # annoying message 'No tests were found!!!' is printed to
-            # stderr by ctest, but it exits with return code 0.
-            sys.stderr.write(stderr)
-            raise RuntimeError("ctest failed with the above error")
-        o = o.split("\n")
-        # Extract the third line that follows each line containing ': Test
-        # command:'
-        commands = []
-        i = 0
-        while i < len(o):
-            line = o[i]
-            m = re.match(r"(^[^:]*): Test command: .*$", line)
-            if m:
-                prefix = f"{m.group(1)}: "
-                command = None
-                i += 1
-                while i < len(o) and o[i].startswith(prefix):
-                    command = o[i][len(prefix) :]
-                    i += 1
-                if command:
-                    commands.append(command)
-            i += 1
-        if commands:
-            tests[label] = commands
+    for test in json.loads(p.stdout).get("tests", []):
+        command = test.get("command")
+        if not command:
+            continue
+        properties = {i["name"]: i["value"] for i in test.get("properties", [])}
+        for label in properties.get("LABELS", []):
+            tests.setdefault(label, []).append(shlex.join(command))
+    write_cache(cache_file, {"files": files, "tests": tests})
     if log_lines is not None:
         log_lines += [
             "Final test dictionary:",
@@ -102,58 +118,34 @@ def get_test_commands(log_lines=None):
     return tests
 
 
-def brainvisa_cmake_component_version(src):
-    # Check pyproject.toml
-    pyproject_toml = src / "pyproject.toml"
-    if pyproject_toml.exists():
-        with open(pyproject_toml) as f:
-            p = toml.load(f)
-        version = p.get("project", {}).get("version")
-        if version is None:
-            raise ValueError(f"Cannot find version in {pyproject_toml}")
-        return version
-
-    # Check info.py
-    info_py = list(
-        itertools.chain(
-            src.glob("info.py"), src.glob("*/info.py"), src.glob("python/*/info.py")
-        )
-    )
-    if info_py:
-        if len(info_py) > 1:
-            raise ValueError(
-                f"Cannot choose info.py among: {', '.join(str(i) for i in info_py)}"
-            )
+def dependency_pins(recipe, recipes, fingerprints, release_history):
+    """
+    Return the pins of the internal dependencies of a recipe: the version of
+    the dependency or, for virtual packages whose version follows the
+    environment version, their fingerprint.
+    """
+    pins = {}
+    for dependency in recipe["soma-forge"].get("internal-dependencies", []):
+        if dependency in fingerprints and (
+            recipes[dependency]["soma-forge"]["type"] == "virtual"
+        ):
+            pins[dependency] = fingerprints[dependency]
+        elif dependency in recipes:
+            pins[dependency] = recipes[dependency]["package"]["version"]
+        else:
+            pins[dependency] = release_history.get(dependency, {}).get("version")
+    return pins
+
 
-        info_py = info_py[0]
-        d = {}
-        with open(info_py) as f:
-            exec(compile(f.read(), info_py, "exec"), d, d)
-        return f"{d['version_major']}.{d['version_minor']}.{d['version_micro']}"
-
-    # Check project_info.cmake
-    project_info = src / "project_info.cmake"
-    if not project_info.exists():
-        project_info = src / "cmake" / "project_info.cmake"
-    if project_info.exists():
-        v = [None, None, None]
-        with open(project_info) as f:
-            p = re.compile(r"\s*set\(\s*([^ \t]*)\s*(.*[^ \t])\s*\)")
-            for line in f:
-                match = p.match(line)
-                if match:
-                    variable, value = match.groups()
-                    if variable == "BRAINVISA_PACKAGE_VERSION_MAJOR":
-                        v[0] = value
-                    elif variable == "BRAINVISA_PACKAGE_VERSION_MINOR":
-                        v[1] = value
-                    elif variable == "BRAINVISA_PACKAGE_VERSION_PATCH":
-                        v[2] = value
-        return ".".join(v)
-
-    raise ValueError(
-        f"Cannot find brainvisa-cmake component version in {pyproject_toml}"
+def package_fingerprint(recipe_contents, changesets, pins, build_string):
+    """
+    Return a hash of all inputs of a package build
+    """
+    h = hashlib.sha256()
+    h.update(
+        json.dumps([recipe_contents, changesets, pins, build_string]).encode()
     )
+    return h.hexdigest()
 
 
 @cli.command()
@@ -162,18 +154,37 @@ def debug(directory):
     pixi_root = pathlib.Path(directory)
     for src in (pixi_root / "src").iterdir():
         if src.is_dir():
-            print(src.name, "==", brainvisa_cmake_component_version(src))
+            print(src.name, "==", component_version(src))
 
 
 @cli.command()
 @click.option("--force", is_flag=True)
 @click.option("--test", type=bool, default=False)
+@click.option(
+    "--deferred-tests",
+    is_flag=True,
+    help="Build packages without tests and test them all at the end in a "
+    "single environment",
+)
+@click.option(
+    "--explain",
+    is_flag=True,
+    help="Print the chain of reasons that selected each package",
+)
 @click.option(
     "--publication-directory", type=click.Path(), default="/drf/neuro-forge/public"
 )
 @click.argument("pixi_directory", type=click.Path())
 @click.argument("packages", type=str, nargs=-1)
-def packaging_plan(pixi_directory, publication_directory, packages, force, test=True):
+def packaging_plan(
+    pixi_directory,
+    publication_directory,
+    packages,
+    force,
+    explain,
+    deferred_tests,
+    test=True,
+):
     if not publication_directory or publication_directory.lower() == "none":
         publication_directory = None
     else:
@@ -193,9 +204,9 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
     plan_dir = pixi_root / "plan"
 
     # Check if a plan file already exists and can be erased
-    history_file = plan_dir / "history.json"
+    journal_file = plan_dir / "journal.jsonl"
     if plan_dir.exists():
-        if history_file.exists() and not force:
+        if journal_file.exists() and not force:
             raise RuntimeError(
                 f"A plan already exists in {plan_dir} and was used. Erase it or use --force option"
             )
@@ -242,7 +253,26 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
 
     recipes = {}
     all_packages = build_info["all_packages"]
-    selected_packages = set()
+
+    # Get the state of all component source trees at once
+    start = time.monotonic()
+    repositories = scan_repositories(
+        pixi_root / "src" / component
+        for node in recipe_graph()
+        if node.name in all_packages and selector.match(node.name)
+        for component in node.components
+    )
+    print(
+        f"Scanned {len(repositories)} source repositories in "
+        f"{time.monotonic() - start:.1f}s"
+    )
+    for src, status in sorted(
+        repositories.items(), key=lambda i: i[1]["seconds"], reverse=True
+    ):
+        print(f"    {status['seconds']:.2f}s {src.name}")
+
+    selected_packages = {}
+    fingerprints = {}
     # Get ordered selection of recipes. Order is based on package
     # dependencies. Recipes are selected according to user selection and
     # modification since last packaging
@@ -254,6 +284,8 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
         if not selector.match(package):
             print(f"Ignore package {package} (excluded by parameters)")
             continue
+        recipe_contents = json.dumps(recipe, sort_keys=True)
+        published = release_history.get(package, {})
         components = recipe["soma-forge"].get("components", [])
         if components:
             # Parse components and do the following:
@@ -267,54 +299,82 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
             for component in components:
                 src = pixi_root / "src" / component
                 if package_version is None:
-                    package_version = brainvisa_cmake_component_version(src)
-                repo = git.Repo(src)
-                if repo.is_dirty():
+                    package_version = component_version(src)
+                status = repositories[src]
+                if status["modified"]:
                     src_errors.append(f"repository {src} contains uncomited files")
-                elif repo.untracked_files:
+                elif status["untracked"]:
                     src_errors.append(f"repository {src} has local modifications")
-                changesets[component] = str(repo.head.commit)
-            if changesets != release_history.get(package, {}).get("changesets"):
+                changesets[component] = status["commit"]
+            recipe["package"]["version"] = package_version
+            fingerprints[package] = package_fingerprint(
+                recipe_contents,
+                changesets,
+                dependency_pins(recipe, recipes, fingerprints, release_history),
+                build_info["build_string"],
+            )
+            if changesets != published.get("changesets"):
                 print(
                     f"Select {package} for building because detected changes in source"
                 )
-                selected_packages.add(package)
+                selected_packages[package] = "detected changes in source"
+            elif published.get("fingerprint", fingerprints[package]) != fingerprints[
+                package
+            ]:
+                print(
+                    f"Select {package} for building because recipe or dependencies changed"
+                )
+                selected_packages[package] = "recipe or dependencies changed"
             else:
                 print(f"No change detected in package {package}")
 
             # Write build section in recipe
             recipe.setdefault("build", {})["string"] = build_info["build_string"]
+            # Components are installed once in plan/stage by the
+            # stage_components action. The package copies files from there
+            # and replaces the stage prefix by its own in text files. Since
+            # rattler-build cannot relocate paths outside of $PREFIX,
+            # stage_components fails if a binary file or a link still uses
+            # the stage. The check is repeated after the copy.
+            stage_dir = plan_dir / "stage"
             recipe["build"]["script"] = "\n".join(
-                (
-                    f"cd '{pixi_root}'",
-                    f"pixi run --manifest-path='{pixi_root}/pixi.toml' bash << END",
-                    'cd "\\$CASA_BUILD"',
-                    'export BRAINVISA_INSTALL_PREFIX="$PREFIX"',
-                    f"for component in {' '.join(components)}; do",
-                    "  make install-\\${component}",
-                    "  make install-\\${component}-dev",
-                    "  make install-\\${component}-usrdoc",
-                    "  make install-\\${component}-devdoc",
-                    "  make install-\\${component}-test",
-                    "done",
-                    "END",
+                itertools.chain.from_iterable(
+                    (
+                        f"cp -a --reflink=auto '{stage}/.' \"$PREFIX/\"",
+                        f"grep -rlIZF '{stage}' \"$PREFIX\" | "
+                        f"xargs -0 -r sed -i 's|{stage}|'\"$PREFIX\"'|g'",
+                        f"if grep -rlF '{stage}' \"$PREFIX\" || "
+                        f"find \"$PREFIX\" -lname '{stage}/*' | grep .; then",
+                        f"  echo 'ERROR: files above refer to {stage}' >&2",
+                        "  exit 1",
+                        "fi",
+                    )
+                    for stage in (stage_dir / component for component in components)
                 )
             )
 
-            # Set package version in recipe
-            recipe["package"]["version"] = package_version
             # Save information in recipe because we do not know yet
             # if package will be selected for building. It will be known
             # later when dependencies are resolved.
             recipe["soma-forge"]["src_errors"] = src_errors
             recipe["soma-forge"]["changesets"] = changesets
         elif recipe["soma-forge"]["type"] == "virtual":
+            # A virtual package is rebuilt only if its dependency pins changed
+            fingerprints[package] = package_fingerprint(
+                recipe_contents,
+                None,
+                dependency_pins(recipe, recipes, fingerprints, release_history),
+                build_info["build_string"],
+            )
             recipe["package"]["version"] = environment_version
             recipe.setdefault("build", {})["string"] = build_info["build_string"]
-            print(
-                f"Select virtual package {package} {environment_version} for building"
-            )
-            selected_packages.add(package)
+            if published.get("fingerprint") != fingerprints[package]:
+                print(
+                    f"Select virtual package {package} {environment_version} for building"
+                )
+                selected_packages[package] = "dependency pins changed"
+            else:
+                print(f"No change detected in virtual package {package}")
         else:
             raise Exception(
                 f"Invalid recipe for {package} (bad type or no component defined)"
@@ -322,24 +382,24 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
         recipes[package] = recipe
 
     # Select new packages that are compiled and depend on, at least, one selected compiled package
-    selection_modified = True
-    while selection_modified:
-        selection_modified = False
-        for package, recipe in recipes.items():
-            if package in selected_packages:
-                continue
-            if recipe["soma-forge"]["type"] == "compiled":
-                for other_package in recipe["soma-forge"].get(
-                    "internal-dependencies", []
-                ):
-                    if recipes[other_package]["soma-forge"]["type"] != "compiled":
-                        continue
-                    if other_package in selected_packages:
-                        print(
-                            f"Select {package} for building because {other_package} is selected"
-                        )
-                        selected_packages.add(package)
-                        selection_modified = True
+    selected_packages = rebuild_impact(selected_packages, candidates=recipes)
+    for package, reasons in selected_packages.items():
+        if len(reasons) > 1:
+            print(
+                f"Select {package} for building because {reasons[1][0]} is selected"
+            )
+        if explain:
+            print(f"{package}:")
+            for reason_package, reason in reasons:
+                print(f"    {reason_package}: {reason}")
+
+    if not selected_packages:
+        # Nothing changed since last release: keep environment version and
+        # write an empty plan
+        print("Nothing changed since last release, the plan is empty")
+        with open(plan_dir / "actions.yaml", "w") as f:
+            yaml.safe_dump([], f)
+        return
 
     # Generate rattler-build recipe and action for soma-env package
     print(f"Generate recipe for soma-env {environment_version}")
@@ -364,10 +424,11 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
 
     # Generate rattler-build recipe and actions for selected packages
     package_actions = []
+    staged_components = []
     for package, recipe in recipes.items():
         if package not in selected_packages:
             continue
-        print(f"Generate recipe for {package} {recipe["package"]["version"]}")
+        print(f"Generate recipe for {package} {recipe['package']['version']}")
         if not force:
             src_errors = recipe["soma-forge"].get("src_errors")
             if src_errors:
@@ -398,53 +459,11 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
             component = recipe["soma-forge"]["components"][0]
             # Find file to change
             src = pixi_root / "src" / component
-            file = src / "project_info.cmake"
-            if file.exists():
-                version_regexps = (
-                    re.compile(
-                        r"(\bset\s*\(\s*BRAINVISA_PACKAGE_VERSION_MAJOR\s*)"
-                        r"([0-9]+)(\s*\))",
-                        re.IGNORECASE,
-                    ),
-                    re.compile(
-                        r"(\bset\s*\(\s*BRAINVISA_PACKAGE_VERSION_MINOR\s*)"
-                        r"([0-9]+)(\s*\))",
-                        re.IGNORECASE,
-                    ),
-                    re.compile(
-                        r"(\bset\s*\(\s*BRAINVISA_PACKAGE_VERSION_PATCH\s*)"
-                        r"([0-9]+)(\s*\))",
-                        re.IGNORECASE,
-                    ),
-                )
-            else:
-                file_format = "python"
-                version_regexps = (
-                    re.compile(r"(\bversion_major\s*=\s*)([0-9]+)(\b)"),
-                    re.compile(r"(\bversion_minor\s*=\s*)([0-9]+)(\b)"),
-                    re.compile(r"(\bversion_micro\s*=\s*)([0-9]+)(\b)"),
-                )
-                if not file.exists():
-                    files = list(
-                        itertools.chain(
-                            src.glob("info.py"),
-                            src.glob("*/info.py"),
-                            src.glob("python/*/info.py"),
-                        )
-                    )
-                    if not files:
-                        raise RuntimeError(
-                            f"Cannot find component version file (info.py or project_info.cmake) in {src}"
-                        )
-                    file = files[0]
-            with open(file) as f:
-                file_contents = f.read()
-            for regex, version_component in zip(version_regexps, new_version):
-                file_contents, _ = regex.subn(
-                    f"\\g<1>{version_component:d}\\g<3>", file_contents
-                )
+            file, file_contents = set_component_version(src, new_version)
             actions.append(
                 {
+                    "id": f"modify_file:{package}",
+                    "depends": [],
                     "action": "modify_file",
                     "kwargs": {
                         "file": str(file),
@@ -455,6 +474,8 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
 
             commit_actions.append(
                 {
+                    "id": f"git_commit:{package}",
+                    "depends": [f"modify_file:{package}"],
                     "action": "git_commit",
                     "kwargs": {
                         "repo": str(src),
@@ -464,6 +485,8 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
                 }
             )
 
+        staged_components.extend(recipe["soma-forge"].get("components", []))
+
         # Remove soma-forge specific data from recipe
         recipe.pop("soma-forge", None)
 
@@ -472,37 +495,82 @@ def packaging_plan(pixi_directory, publication_directory, packages, force, test=
         with open(plan_dir / "recipes" / package / "recipe.yaml", "w") as f:
             yaml.safe_dump(recipe, f)
 
+        # A package can be built as soon as soma-env, the staged components
+        # and the selected packages it depends on are built
         package_actions.append(
-            {"action": "create_package", "args": [package], "kwargs": {"test": test}}
+            {
+                "id": f"create_package:{package}",
+                "depends": ["create_package:soma-env", "stage_components"]
+                + [
+                    f"create_package:{i}"
+                    for i in internal_dependencies
+                    if i in selected_packages
+                ],
+                "action": "create_package",
+                "args": [package],
+                "kwargs": {"test": test and not deferred_tests},
+            }
         )
 
         release_history.setdefault(package, {})["changesets"] = changesets
         build_string = recipe.get("build", {}).get("string")
         release_history[package]["build_string"] = build_string
         release_history[package]["version"] = recipe["package"]["version"]
+        release_history[package]["fingerprint"] = fingerprints[package]
 
     if commit_actions:
         actions.extend(commit_actions)
-        actions.append({"action": "rebuild"})
+        actions.append(
+            {
+                "id": "rebuild",
+                "depends": [i["id"] for i in commit_actions],
+                "action": "rebuild",
+            }
+        )
     else:
         # Add an action to assess that compilation was successfully done
         actions.extend((
             {
+                "id": "check_build_status",
+                "depends": [],
                 "action": "check_build_status",
             },
             {
+                "id": "create_package:soma-env",
+                "depends": ["check_build_status"],
                 "action": "create_package",
                 "args": ["soma-env"],
                 "kwargs": {"test": False},
             },
+            {
+                "id": "stage_components",
+                "depends": ["check_build_status"],
+                "action": "stage_components",
+                "kwargs": {"components": staged_components},
+            },
         ))
 
         actions.extend(package_actions)
+        publish_dependencies = ["create_package:soma-env"] + [
+            i["id"] for i in package_actions
+        ]
+        if deferred_tests:
+            actions.append(
+                {
+                    "id": "test_packages",
+                    "depends": [i["id"] for i in package_actions],
+                    "action": "test_packages",
+                    "kwargs": {"packages": [i["args"][0] for i in package_actions]},
+                }
+            )
+            publish_dependencies.append("test_packages")
         release_history["environment_version"] = environment_version
         packages_dir = pixi_root / "plan" / "packages"
         if publication_directory is not None:
             actions.append(
                 {
+                    "id": "publish",
+                    "depends": publish_dependencies,
                     "action": "publish",
                     "kwargs": {
                         "environment": build_info["environment"],
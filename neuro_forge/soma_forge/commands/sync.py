@@ -0,0 +1,179 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import pathlib
+import sys
+
+import click
+from rich.table import Table
+
+from . import cli, console
+from ...cache import format_size
+from ..environments import component_source
+from ..git import (
+    default_mirror_dir,
+    iter_mirrors,
+    mirror_path,
+    sync_repository,
+    update_mirror,
+)
+from ..recipes import selected_recipes
+
+
+@cli.command()
+@click.argument("directory", type=click.Path())
+@click.argument("packages", type=str, nargs=-1)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=8,
+    help="Maximum number of repositories synchronized simultaneously",
+)
+@click.option(
+    "--shallow",
+    is_flag=True,
+    help="Only clone the last commit instead of doing a partial clone",
+)
+@click.option(
+    "--timeout",
+    type=float,
+    default=None,
+    help="Maximum time in seconds allowed to synchronize a repository",
+)
+@click.option(
+    "--mirror-dir",
+    type=click.Path(),
+    envvar="SOMA_FORGE_MIRROR_DIR",
+    default=None,
+    help="Directory of bare git mirrors shared between workspaces. Mirrors "
+    "are updated first and clones use their objects (via git alternates).",
+)
+def sync(directory, packages, jobs, shallow, timeout, mirror_dir):
+    """Clone or update the sources of all components of selected packages"""
+    pixi_root = pathlib.Path(directory).absolute()
+    with open(pixi_root / "conf" / "build_info.json") as f:
+        build_info = json.load(f)
+    environment = build_info["environment"]
+    packages = packages or build_info.get("packages") or ["all"]
+    if isinstance(packages, str):
+        packages = [packages]
+
+    sources = {
+        "brainvisa-cmake": ("https://github.com/brainvisa/brainvisa-cmake", "master")
+    }
+    for recipe in selected_recipes(packages):
+        for component in recipe["soma-forge"].get("components", []):
+            source = component_source(component, environment)
+            if not source:
+                raise ValueError(
+                    f"Cannot find source for component {component} in "
+                    f"environment {environment}"
+                )
+            sources[component] = source
+
+    def sync_component(component, url, branch):
+        reference = None
+        if mirror_dir:
+            report = update_mirror(mirror_dir, url, timeout=timeout)
+            if report["status"] != "ok":
+                return report
+            reference = mirror_path(mirror_dir, url)
+        return sync_repository(
+            url,
+            branch,
+            pixi_root / "src" / component,
+            shallow=shallow,
+            timeout=timeout,
+            reference=reference,
+        )
+
+    reports = {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {
+            executor.submit(sync_component, component, url, branch): component
+            for component, (url, branch) in sources.items()
+        }
+        for count, future in enumerate(as_completed(futures), 1):
+            component = futures[future]
+            report = reports[component] = future.result()
+            print(
+                f"[{count}/{len(futures)}] {report['action']} {component}: "
+                f"{report['status']} ({format_size(report['size'])}, "
+                f"{report['seconds']:.1f}s)",
+                flush=True,
+            )
+
+    table = Table()
+    for column in ("component", "branch", "action", "status", "size", "duration"):
+        table.add_column(column)
+    for component, report in sorted(
+        reports.items(), key=lambda i: i[1]["seconds"], reverse=True
+    ):
+        table.add_row(
+            component,
+            report.get("branch", ""),
+            report["action"],
+            report["status"],
+            format_size(report["size"]),
+            f"{report['seconds']:.1f}s",
+        )
+    console.print(table)
+    failed = [c for c, r in reports.items() if r["status"] != "ok"]
+    for component in failed:
+        console.print(
+            f"[red]{component}: {reports[component].get('error', 'timeout')}[/red]"
+        )
+    if failed:
+        sys.exit(1)
+
+
+@cli.group()
+def mirror():
+    """Manage the git mirrors shared between workspaces"""
+    pass
+
+
+@mirror.command()
+@click.argument("urls", type=str, nargs=-1)
+@click.option(
+    "--mirror-dir",
+    type=click.Path(),
+    envvar="SOMA_FORGE_MIRROR_DIR",
+    default=None,
+    help="Directory of bare git mirrors (default=~/.cache/neuro-forge/git-mirrors)",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=8,
+    help="Maximum number of mirrors updated simultaneously",
+)
+@click.option(
+    "--timeout",
+    type=float,
+    default=None,
+    help="Maximum time in seconds allowed to update a mirror",
+)
+def update(urls, mirror_dir, jobs, timeout):
+    """Create mirrors for the given URLs or update all existing mirrors"""
+    mirror_dir = pathlib.Path(mirror_dir or default_mirror_dir())
+    urls = urls or list(iter_mirrors(mirror_dir))
+    failed = False
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [
+            executor.submit(update_mirror, mirror_dir, url, timeout=timeout)
+            for url in urls
+        ]
+        for future in as_completed(futures):
+            report = future.result()
+            print(
+                f"{report['action']} {report['url']}: {report['status']} "
+                f"({format_size(report['size'])}, {report['seconds']:.1f}s)",
+                flush=True,
+            )
+            if report["status"] != "ok":
+                failed = True
+                print(report.get("error", "timeout"), file=sys.stderr)
+    if failed:
+        sys.exit(1)
@@ -1,12 +1,360 @@
-import git
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import fnmatch
+import hashlib
+import os
+import pathlib
+import re
+import shutil
+import subprocess
+import threading
+import time
 
-def iter_tags(url):
+from ..json_cache import read_cache, user_cache_dir, write_cache
+
+
+_refs_lock = threading.Lock()
+default_refs_ttl = 3600
+
+
+def remote_refs(url, ttl=default_refs_ttl, cache_file=None):
+    """
+    Return a dictionary whose keys are the refs of a remote repository
+    (e.g. refs/heads/master) and values are commit ids. Results of
+    git ls-remote are cached on disk and reused for ttl seconds.
+    """
+    if cache_file is None:
+        cache_file = user_cache_dir() / "remote-refs.json"
+    with _refs_lock:
+        entry = read_cache(cache_file).get(url)
+    if entry and time.time() - entry["time"] < ttl:
+        return entry["refs"]
+    output = subprocess.check_output(
+        ["git", "ls-remote", url],
+        text=True,
+        stderr=subprocess.PIPE,
+        env=dict(os.environ, GIT_TERMINAL_PROMPT="0"),
+    )
+    refs = {}
+    for line in output.splitlines():
+        commit, ref = line.split("\t", 1)
+        refs[ref] = commit
+    with _refs_lock:
+        cache = read_cache(cache_file)
+        cache[url] = {"time": time.time(), "refs": refs}
+        write_cache(cache_file, cache)
+    return refs
+
+
+def iter_tags(url, ttl=default_refs_ttl):
+    return (
+        i.rsplit("/", 1)[-1]
+        for i in remote_refs(url, ttl)
+        if i.startswith("refs/tags/") and not i.endswith("^{}")
+    )
+
+
+def iter_branches(url, ttl=default_refs_ttl):
     return (
         i.rsplit("/", 1)[-1]
-        for i in git.cmd.Git().ls_remote(url, tags=True).split("\n")
-        if not i.endswith("^{}")
+        for i in remote_refs(url, ttl)
+        if i.startswith("refs/heads/")
+    )
+
+
+def repository_status(path):
+    """
+    Return the state of a git working tree using a single call to
+    ``git status --porcelain=v2 --branch``. The result is a dictionary with
+    the following items:
+        - "commit": current commit (None for a repository without commit)
+        - "branch": current branch (None if HEAD is detached)
+        - "modified": True if tracked files have uncommitted changes
+        - "untracked": True if the working tree contains untracked files
+        - "seconds": time taken by git status
+    """
+    start = time.monotonic()
+    output = subprocess.check_output(
+        ["git", "-C", str(path), "status", "--porcelain=v2", "--branch"], text=True
+    )
+    result = {
+        "commit": None,
+        "branch": None,
+        "modified": False,
+        "untracked": False,
+    }
+    for line in output.splitlines():
+        if line.startswith("# branch.oid "):
+            oid = line.split()[2]
+            result["commit"] = None if oid == "(initial)" else oid
+        elif line.startswith("# branch.head "):
+            head = line.split()[2]
+            result["branch"] = None if head == "(detached)" else head
+        elif line[:2] in ("1 ", "2 ", "u "):
+            result["modified"] = True
+        elif line.startswith("? "):
+            result["untracked"] = True
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def scan_repositories(paths, jobs=None):
+    """
+    Get the status of several git working trees concurrently. Return a
+    dictionary whose keys are paths and values are the result of
+    repository_status().
+    """
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(paths, executor.map(repository_status, paths)))
+
+
+def find_repositories(src, max_depth=None, ignore=()):
+    """
+    Iterate over git working trees found in src. Directories whose name
+    matches one of the ignore fnmatch patterns are skipped. Subdirectories
+    of git working trees are not explored, nor directories deeper than
+    max_depth (src has depth 0).
+    """
+    stack = [(pathlib.Path(src), 0)]
+    while stack:
+        directory, depth = stack.pop()
+        if (directory / ".git").exists():
+            yield directory
+        elif max_depth is None or depth < max_depth:
+            stack.extend(
+                (i, depth + 1)
+                for i in sorted(directory.iterdir(), reverse=True)
+                if i.is_dir()
+                and not any(fnmatch.fnmatch(i.name, pattern) for pattern in ignore)
+            )
+
+
+def check_merge_needed(path, branch=None, timeout=None):
+    """
+    Fetch a git working tree and check if the remote branch (by default
+    master, or main if there is no master) is not merged in the current
+    branch. Return a report dictionary with the following items:
+        - "path": path of the working tree
+        - "branch": remote branch that is checked
+        - "status": "merge" if a merge is needed, "ok" if not, "timeout"
+          if fetch was not done in timeout seconds or "error"
+        - "error": error message (only if status is "error")
+        - "commands": suggested commands to merge the remote branch
+        - "seconds": time taken by the check
+    """
+    start = time.monotonic()
+    report = {"path": str(path), "branch": branch, "commands": []}
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    try:
+        subprocess.run(
+            ["git", "-C", str(path), "fetch", "--quiet"],
+            check=True,
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+            env=env,
+        )
+        remote_branches = subprocess.check_output(
+            [
+                "git",
+                "-C",
+                str(path),
+                "for-each-ref",
+                "--format=%(refname:short)",
+                "refs/remotes/origin",
+            ],
+            text=True,
+        ).split()
+        if branch is None:
+            branch = "master" if "origin/master" in remote_branches else "main"
+            report["branch"] = branch
+        non_merged = subprocess.check_output(
+            ["git", "-C", str(path), "branch", "-r", "--no-merged"], text=True
+        ).split()
+        if f"origin/{branch}" in non_merged:
+            report["status"] = "merge"
+            report["commands"] = [
+                f"git -C '{path}' merge --no-edit origin/{branch}",
+                f"git -C '{path}' push",
+            ]
+        else:
+            report["status"] = "ok"
+    except subprocess.TimeoutExpired:
+        report["status"] = "timeout"
+    except subprocess.CalledProcessError as e:
+        report["status"] = "error"
+        report["error"] = (e.stderr or str(e)).strip()
+    report["seconds"] = time.monotonic() - start
+    return report
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def sync_repository(
+    url, branch, dest, shallow=False, timeout=None, reference=None
+):
+    """
+    Clone a git repository in dest or update it if it already exists.
+    If reference is given, it is a local mirror of the repository whose
+    objects are shared with the clone (using git alternates). Otherwise
+    clones are partial (without blobs that are downloaded on demand) or
+    shallow (only last commit) if shallow is True. An existing repository
+    is fetched and fast-forwarded if branch is its current branch. Return a
+    report dictionary with "path", "url", "branch", "action" ("clone" or
+    "update"), "status" ("ok", "timeout" or "error"), "error" (only on
+    error), "size" (size of the repository in bytes) and "seconds" items.
+    """
+    start = time.monotonic()
+    dest = pathlib.Path(dest)
+    report = {"path": str(dest), "url": url, "branch": branch}
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    if (dest / ".git").exists():
+        report["action"] = "update"
+        commands = [["git", "-C", str(dest), "fetch", "origin", branch]]
+        current = subprocess.run(
+            ["git", "-C", str(dest), "symbolic-ref", "--short", "-q", "HEAD"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        if current == branch:
+            commands.append(
+                ["git", "-C", str(dest), "merge", "--ff-only", "FETCH_HEAD"]
+            )
+    else:
+        report["action"] = "clone"
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        command = ["git", "clone", "--branch", branch]
+        if reference is not None:
+            command += ["--reference", str(reference)]
+        elif shallow:
+            command += ["--depth", "1"]
+        else:
+            command += ["--filter=blob:none"]
+        commands = [command + [url, str(dest)]]
+    try:
+        for command in commands:
+            subprocess.run(
+                command,
+                check=True,
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+                env=env,
+            )
+        report["status"] = "ok"
+    except subprocess.TimeoutExpired:
+        report["status"] = "timeout"
+    except subprocess.CalledProcessError as e:
+        report["status"] = "error"
+        report["error"] = (e.stderr or str(e)).strip()
+    report["size"] = directory_size(dest) if dest.exists() else 0
+    report["seconds"] = time.monotonic() - start
+    return report
+
+
+def default_mirror_dir():
+    """
+    Return the directory containing git mirrors. It can be set with
+    SOMA_FORGE_MIRROR_DIR environment variable.
+    """
+    return pathlib.Path(
+        os.environ.get("SOMA_FORGE_MIRROR_DIR") or user_cache_dir() / "git-mirrors"
     )
 
 
-def iter_branches(url):
-    return (i.rsplit("/", 1)[-1] for i in git.cmd.Git().ls_remote(url, heads=True).split("\n"))
+def mirror_path(mirror_dir, url):
+    """
+    Return the path of the bare repository mirroring url in mirror_dir
+    """
+    name = re.sub(r"^[a-z+]+://|(\.git)?/*$", "", url)
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+    name = name.strip("_")[-60:]
+    digest = hashlib.sha1(url.encode()).hexdigest()[:8]
+    return pathlib.Path(mirror_dir) / f"{name}-{digest}.git"
+
+
+def update_mirror(mirror_dir, url, timeout=None):
+    """
+    Create or update the mirror of url in mirror_dir. A lock file makes
+    concurrent updates of the same mirror (from several processes or
+    workspaces) safe. Return a report dictionary with "path", "url",
+    "action" ("clone" or "update"), "status" ("ok", "timeout" or "error"),
+    "error" (only on error), "size" and "seconds" items.
+    """
+    start = time.monotonic()
+    mirror = mirror_path(mirror_dir, url)
+    mirror.parent.mkdir(parents=True, exist_ok=True)
+    report = {"path": str(mirror), "url": url}
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    with open(f"{mirror}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if mirror.exists():
+                report["action"] = "update"
+                subprocess.run(
+                    ["git", "-C", str(mirror), "remote", "update", "--prune"],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                    timeout=timeout,
+                    env=env,
+                )
+            else:
+                report["action"] = "clone"
+                tmp = mirror.parent / f".{mirror.name}.tmp"
+                if tmp.exists():
+                    shutil.rmtree(tmp)
+                subprocess.run(
+                    ["git", "clone", "--mirror", url, str(tmp)],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                    timeout=timeout,
+                    env=env,
+                )
+                # Workspaces use the objects of the mirror, they must never
+                # be removed by garbage collection.
+                for option, value in (
+                    ("gc.pruneExpire", "never"),
+                    ("gc.reflogExpireUnreachable", "never"),
+                ):
+                    subprocess.check_call(
+                        ["git", "-C", str(tmp), "config", option, value]
+                    )
+                tmp.rename(mirror)
+            report["status"] = "ok"
+        except subprocess.TimeoutExpired:
+            report["status"] = "timeout"
+        except subprocess.CalledProcessError as e:
+            report["status"] = "error"
+            report["error"] = (e.stderr or str(e)).strip()
+    report["size"] = directory_size(mirror) if mirror.exists() else 0
+    report["seconds"] = time.monotonic() - start
+    return report
+
+
+def iter_mirrors(mirror_dir):
+    """
+    Iterate over the URLs of all mirrors in mirror_dir
+    """
+    mirror_dir = pathlib.Path(mirror_dir)
+    if not mirror_dir.exists():
+        return
+    for mirror in sorted(mirror_dir.glob("*.git")):
+        url = subprocess.run(
+            ["git", "-C", str(mirror), "config", "remote.origin.url"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        if url:
+            yield url
@@ -1,69 +1,381 @@
+import collections
 import pathlib
+from types import MappingProxyType
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+"""
+Soma-forge recipes. All recipe files are parsed once and stored in a
+RecipeGraph whose nodes are immutable. Dependencies and dependents (direct
+and transitive) as well as topological levels are computed when the graph
+is created. Transitive closures are stored as bitsets (Python integers
+where bit i corresponds to the node with index i) to make selection and
+impact queries simple bitwise operations.
+"""
+
+_recipe_graph = None
+
+
+def freeze(value):
+    """
+    Return an immutable version of a value parsed from a YAML file: dicts
+    are converted to read-only mappings and lists to tuples.
+    """
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(i) for i in value)
+    return value
+
+
+def thaw(value):
+    """
+    Return a mutable copy of a value returned by freeze()
+    """
+    if isinstance(value, MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(i) for i in value]
+    return value
+
+
+class CycleError(ValueError):
+    """
+    Raised when internal dependencies of recipes contain a cycle. The
+    packages of the cycle are in the packages attribute.
+    """
+
+    def __init__(self, packages):
+        self.packages = packages
+        super().__init__(
+            f"Dependency cycle between soma-forge packages: {' -> '.join(packages + packages[:1])}"
+        )
+
+
+def find_cycle(dependencies):
+    """
+    Return the list of packages forming a cycle given a dictionary whose
+    keys are packages and values are dependencies. All packages must have
+    at least one dependency among the keys (this is the case for packages
+    that cannot be sorted by Kahn's algorithm).
+    """
+    path = []
+    position = {}
+    package = min(dependencies)
+    while package not in position:
+        position[package] = len(path)
+        path.append(package)
+        package = min(i for i in dependencies[package] if i in dependencies)
+    return path[position[package] :]
+
+
+class RecipeNode:
+    """
+    Immutable node of a RecipeGraph. Attributes are:
+        - name: package name
+        - index: position of the node in the topological order of the graph
+        - bit: 1 << index
+        - type: soma-forge type of the package (compiled, interpreted, virtual)
+        - components: tuple of brainvisa-cmake components of the package
+        - dependencies: tuple of direct internal dependencies
+        - dependents: tuple of packages having this one as direct dependency
+        - closure: bitset of transitive dependencies
+        - dependents_closure: bitset of transitive dependents
+        - level: 0 for packages without dependency, otherwise 1 + highest
+          level of dependencies
+        - recipe: frozen content of the recipe file
+    """
+
+    __slots__ = (
+        "name",
+        "index",
+        "bit",
+        "type",
+        "components",
+        "dependencies",
+        "dependents",
+        "closure",
+        "dependents_closure",
+        "level",
+        "recipe",
+    )
+
+    def __init__(self, **kwargs):
+        for k in self.__slots__:
+            object.__setattr__(self, k, kwargs[k])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+class RecipeGraph:
+    """
+    Graph of soma-forge recipes linked by their internal-dependencies.
+    Iterating over the graph yields nodes in topological order (dependencies
+    first). CycleError is raised if dependencies contain a cycle.
+    """
+
+    def __init__(self, recipes):
+        recipes = {r["package"]["name"]: r for r in recipes}
+        dependencies = {}
+        for package, recipe in recipes.items():
+            deps = (recipe.get("soma-forge") or {}).get("internal-dependencies") or []
+            unknown = [i for i in deps if i not in recipes]
+            if unknown:
+                raise ValueError(
+                    f"Unknown internal dependencies for {package}: {', '.join(unknown)}"
+                )
+            dependencies[package] = tuple(deps)
+
+        # Kahn's algorithm processed level by level: a level contains all
+        # packages whose dependencies are in previous levels.
+        dependents = {package: [] for package in sorted(recipes)}
+        in_degree = {}
+        for package in dependents:
+            unique = set(dependencies[package])
+            in_degree[package] = len(unique)
+            for dependency in unique:
+                dependents[dependency].append(package)
+        order = []
+        levels = {}
+        level = [package for package, degree in in_degree.items() if degree == 0]
+        depth = 0
+        while level:
+            next_level = []
+            for package in level:
+                levels[package] = depth
+                order.append(package)
+                for dependent in dependents[package]:
+                    in_degree[dependent] -= 1
+                    if in_degree[dependent] == 0:
+                        next_level.append(dependent)
+            level = sorted(next_level)
+            depth += 1
+        if len(order) != len(recipes):
+            raise CycleError(
+                find_cycle({p: d for p, d in dependencies.items() if p not in levels})
+            )
+
+        index = {package: i for i, package in enumerate(order)}
+        closure = {}
+        for package in order:
+            bits = 0
+            for dependency in dependencies[package]:
+                bits |= (1 << index[dependency]) | closure[dependency]
+            closure[package] = bits
+        dependents_closure = {}
+        for package in reversed(order):
+            bits = 0
+            for dependent in dependents[package]:
+                bits |= (1 << index[dependent]) | dependents_closure[dependent]
+            dependents_closure[package] = bits
+
+        self._nodes = tuple(
+            RecipeNode(
+                name=package,
+                index=index[package],
+                bit=1 << index[package],
+                type=recipes[package].get("soma-forge", {}).get("type"),
+                components=tuple(
+                    recipes[package].get("soma-forge", {}).get("components") or []
+                ),
+                dependencies=dependencies[package],
+                dependents=tuple(sorted(dependents[package], key=index.get)),
+                closure=closure[package],
+                dependents_closure=dependents_closure[package],
+                level=levels[package],
+                recipe=freeze(recipes[package]),
+            )
+            for package in order
+        )
+        self._by_name = {node.name: node for node in self._nodes}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __contains__(self, package):
+        return package in self._by_name
+
+    def __getitem__(self, package):
+        return self._by_name[package]
+
+    @property
+    def names(self):
+        return tuple(node.name for node in self._nodes)
+
+    def recipe(self, package):
+        """
+        Return a mutable copy of a recipe. Modifying it does not change the
+        graph.
+        """
+        return thaw(self._by_name[package].recipe)
+
+    def nodes(self, bits):
+        """
+        Return the nodes corresponding to a bitset in topological order
+        """
+        result = []
+        while bits:
+            low = bits & -bits
+            result.append(self._nodes[low.bit_length() - 1])
+            bits ^= low
+        return result
+
+    def levels(self, bits=None):
+        """
+        Iterate over groups of nodes (tuples) that can be built concurrently
+        once all previous groups are built. If bits is given, only the
+        corresponding nodes are considered.
+        """
+        nodes = self._nodes if bits is None else self.nodes(bits)
+        group = []
+        for node in sorted(nodes, key=lambda i: (i.level, i.index)):
+            if group and group[-1].level != node.level:
+                yield tuple(group)
+                group = []
+            group.append(node)
+        if group:
+            yield tuple(group)
+
+    def bits(self, packages):
+        """
+        Return the bitset corresponding to package names
+        """
+        result = 0
+        for package in packages:
+            result |= self._by_name[package].bit
+        return result
+
+    def dependencies(self, package, transitive=False):
+        node = self._by_name[package]
+        if transitive:
+            return tuple(i.name for i in self.nodes(node.closure))
+        return node.dependencies
+
+    def dependents(self, package, transitive=False):
+        node = self._by_name[package]
+        if transitive:
+            return tuple(i.name for i in self.nodes(node.dependents_closure))
+        return node.dependents
+
+    def select(self, selection=None):
+        """
+        Return the nodes (in topological order) of the packages listed in
+        selection and of their dependencies. "all" selects all packages and
+        a name prefixed by "-" removes a package from the selection.
+        """
+        metapackages = {
+            "all": (1 << len(self._nodes)) - 1,
+        }
+        if not selection:
+            selection = ["all"]
+        selected = 0
+        for s in selection:
+            if s.startswith("-"):
+                s = s[1:].strip()
+                remove = True
+            else:
+                remove = False
+            bits = metapackages.get(s)
+            if bits is None:
+                node = self._by_name.get(s)
+                if node is None:
+                    raise ValueError(f"Unknown soma-forge package: {s}")
+                bits = node.bit
+            if remove:
+                selected &= ~bits
+            else:
+                selected |= bits
+        for node in self.nodes(selected):
+            selected |= node.closure
+        return self.nodes(selected)
+
+
+def recipe_graph():
+    """
+    Return the graph of all recipes defined in soma-forge. Recipe files are
+    only read on first call.
+    """
+    global _recipe_graph
+
+    if _recipe_graph is None:
+        recipes = []
+        for recipe_file in sorted(pathlib.Path(__file__).parent.glob("*.yaml")):
+            with open(recipe_file) as f:
+                recipes.append(yaml.load(f, Loader=SafeLoader))
+        _recipe_graph = RecipeGraph(recipes)
+    return _recipe_graph
+
+
+def rebuild_impact(selected, candidates=None, graph=None):
+    """
+    Propagate a selection of packages to rebuild to their dependents. A
+    compiled package must be rebuilt when one of its compiled dependencies
+    is rebuilt. selected is a dictionary whose keys are package names and
+    values are the reason of their selection. If candidates is given, only
+    these packages can be added to the selection. Return a dictionary whose
+    keys are selected package names (in topological order) and values are
+    the chain of (package, reason) that selected them, starting with the
+    package itself and ending with a package of the initial selection.
+    """
+    if graph is None:
+        graph = recipe_graph()
+    chains = {package: [(package, reason)] for package, reason in selected.items()}
+    queue = collections.deque(sorted(selected, key=lambda i: graph[i].index))
+    while queue:
+        node = graph[queue.popleft()]
+        if node.type != "compiled":
+            continue
+        for dependent in node.dependents:
+            if dependent in chains:
+                continue
+            if candidates is not None and dependent not in candidates:
+                continue
+            if graph[dependent].type != "compiled":
+                continue
+            chains[dependent] = [(dependent, f"depends on {node.name}")] + chains[
+                node.name
+            ]
+            queue.append(dependent)
+    return {i: chains[i] for i in sorted(chains, key=lambda i: graph[i].index)}
+
 
 def read_recipe(package):
     """
     Read a single recip given its package name
     """
-    recipe_file = pathlib.Path(__file__).parent / f"{package}.yaml"
-    with open(recipe_file) as f:
-        return yaml.safe_load(f)
+    return recipe_graph().recipe(package)
 
 
 def read_recipes():
     """
     Iterate over all recipes files defined in soma-forge.
     """
-    for recipe_file in (pathlib.Path(__file__).parent).glob("*.yaml"):
-        with open(recipe_file) as f:
-            recipe = yaml.safe_load(f)
-            yield recipe
+    graph = recipe_graph()
+    for node in graph:
+        yield graph.recipe(node.name)
 
 
 def selected_recipes(selection=None):
     """
     Iterate over recipes selected in configuration and their dependencies.
     """
-    # Read recipes
-    recipes = {r["package"]["name"]: r for r in read_recipes()}
-
-    all_packages = set(recipes)
-
-    metapackages = {
-        "all": all_packages,
-    }
-    if not selection:
-        selection = ["all"]
-    selected_packages = set()
-    for s in selection:
-        if s.startswith("-"):
-            s = s[1:].strip()
-            remove = True
-        else:
-            remove = False
-        m = metapackages.get(s)
-        if m is not None:
-            s = m
-        else:
-            s = {s}
-        if remove:
-            selected_packages = selected_packages.difference(s)
-        else:
-            selected_packages.update(s)
-
-    # Walk over selected packages and dependencies
-    stack = list(selected_packages)
-    done = set()
-    while stack:
-        package = stack.pop(0)
-        if package in done:
-            continue
-        recipe = recipes[package]
-        yield recipe
-        done.add(package)
-        dependencies = recipe["soma-forge"].get("internal-dependencies", [])
-        stack.extend(i for i in dependencies if i not in done)
+    graph = recipe_graph()
+    for node in graph.select(selection):
+        yield graph.recipe(node.name)
 
 
 def sorted_recipies():
@@ -71,22 +383,17 @@ def sorted_recipies():
     Iterate over recipes sorted according to their dependencies starting with a
     package without dependency.
     """
-    recipes = {r["package"]["name"]: r for r in selected_recipes()}
-    ready = set()
-    inverted_dependencies = {}
-    for package, recipe in recipes.items():
-        dependencies = recipe["soma-forge"].get("internal-dependencies", [])
-        if not dependencies:
-            ready.add(package)
-        for dependency in dependencies:
-            inverted_dependencies.setdefault(dependency, set()).add(package)
-
-    done = set()
-    while ready:
-        package = ready.pop()
-        yield recipes[package]
-        done.add(package)
-        for dependent in inverted_dependencies.get(package, []):
-            dependencies = recipe.get("internal-dependencies", [])
-            if all(d in done for d in dependencies):
-                ready.add(dependent)
+    graph = recipe_graph()
+    for node in graph:
+        yield graph.recipe(node.name)
+
+
+def recipe_levels(selection=None):
+    """
+    Iterate over groups of package names whose builds can be run
+    concurrently. A group only depends on packages of previous groups.
+    """
+    graph = recipe_graph()
+    selected = graph.bits(i.name for i in graph.select(selection))
+    for level in graph.levels(selected):
+        yield [node.name for node in level]
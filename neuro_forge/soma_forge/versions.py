@@ -0,0 +1,203 @@
+import ast
+import hashlib
+import itertools
+import os
+import re
+
+from ..json_cache import read_cache, user_cache_dir, write_cache
+
+"""
+Static extraction of brainvisa-cmake components versions. The version is
+read from pyproject.toml, info.py or project_info.cmake without executing
+any code. The parsers return the location of the version numbers in the
+file content, so that the same code is used to read a version and to
+write a new one. Parsing results are memoized on disk and reused as long
+as the file did not change (same modification time or same git blob id).
+"""
+
+project_info_re = re.compile(
+    r"\bset\s*\(\s*BRAINVISA_PACKAGE_VERSION_(MAJOR|MINOR|PATCH)\s*([0-9]+)\s*\)",
+    re.IGNORECASE,
+)
+info_py_variables = ("version_major", "version_minor", "version_micro")
+
+
+def version_file(src):
+    """
+    Return the file containing the version of the component whose source
+    directory is src. pyproject.toml is used first, then info.py and
+    finally project_info.cmake.
+    """
+    pyproject_toml = src / "pyproject.toml"
+    if pyproject_toml.exists():
+        return pyproject_toml
+
+    info_py = list(
+        itertools.chain(
+            src.glob("info.py"), src.glob("*/info.py"), src.glob("python/*/info.py")
+        )
+    )
+    if info_py:
+        if len(info_py) > 1:
+            raise ValueError(
+                f"Cannot choose info.py among: {', '.join(str(i) for i in info_py)}"
+            )
+        return info_py[0]
+
+    for project_info in (
+        src / "project_info.cmake",
+        src / "cmake" / "project_info.cmake",
+    ):
+        if project_info.exists():
+            return project_info
+
+    raise ValueError(
+        f"Cannot find component version file (pyproject.toml, info.py or "
+        f"project_info.cmake) in {src}"
+    )
+
+
+def pyproject_spans(content):
+    """
+    Return the location of the version string of the [project] table
+    """
+    section = None
+    offset = 0
+    for line in content.splitlines(keepends=True):
+        match = re.match(r"\s*\[([^\]]*)\]", line)
+        if match:
+            section = match.group(1).strip()
+        elif section == "project":
+            match = re.match(r"\s*version\s*=\s*([\"'])([^\"']*)\1", line)
+            if match:
+                return [(offset + match.start(2), offset + match.end(2))]
+        offset += len(line)
+    return []
+
+
+def info_py_spans(content):
+    """
+    Return the location of the integers assigned to version_major,
+    version_minor and version_micro in an info.py file. The file is parsed
+    but never executed.
+    """
+    lines_offset = [0]
+    for line in content.split("\n"):
+        lines_offset.append(lines_offset[-1] + len(line.encode()) + 1)
+    data = content.encode()
+    spans = {}
+    for node in ast.parse(content).body:
+        if (
+            isinstance(node, ast.Assign)
+            and len(node.targets) == 1
+            and isinstance(node.targets[0], ast.Name)
+            and node.targets[0].id in info_py_variables
+            and isinstance(node.value, ast.Constant)
+            and isinstance(node.value.value, int)
+        ):
+            value = node.value
+            # AST offsets are given in bytes
+            start = lines_offset[value.lineno - 1] + value.col_offset
+            end = lines_offset[value.end_lineno - 1] + value.end_col_offset
+            spans[node.targets[0].id] = (
+                len(data[:start].decode()),
+                len(data[:end].decode()),
+            )
+    if len(spans) != len(info_py_variables):
+        return []
+    return [spans[i] for i in info_py_variables]
+
+
+def project_info_spans(content):
+    """
+    Return the location of major, minor and patch version numbers in a
+    project_info.cmake file
+    """
+    spans = {}
+    for match in project_info_re.finditer(content):
+        spans[match.group(1).upper()] = match.span(2)
+    if len(spans) != 3:
+        return []
+    return [spans[i] for i in ("MAJOR", "MINOR", "PATCH")]
+
+
+def version_spans(file, content):
+    """
+    Return the list of (start, end) locations of the version in the content
+    of a version file. Either a single location containing the full
+    version or one location per version number is returned.
+    """
+    if file.name == "pyproject.toml":
+        spans = pyproject_spans(content)
+    elif file.name == "info.py":
+        spans = info_py_spans(content)
+    else:
+        spans = project_info_spans(content)
+    if not spans:
+        raise ValueError(f"Cannot find version in {file}")
+    return spans
+
+
+def git_blob_id(data):
+    h = hashlib.sha1()
+    h.update(f"blob {len(data)}\0".encode())
+    h.update(data)
+    return h.hexdigest()
+
+
+def read_version(file, cache=None):
+    """
+    Return a (version, spans) tuple for a version file. If cache is given, it
+    is a dictionary used to memoize results. It is updated when necessary.
+    """
+    key = str(file)
+    mtime = os.stat(file).st_mtime_ns
+    entry = cache.get(key) if cache is not None else None
+    if entry and entry["mtime"] == mtime:
+        return entry["version"], [tuple(i) for i in entry["spans"]]
+    with open(file, "rb") as f:
+        data = f.read()
+    blob_id = git_blob_id(data)
+    if not entry or entry["blob"] != blob_id:
+        content = data.decode()
+        spans = version_spans(file, content)
+        version = ".".join(content[start:end] for start, end in spans)
+        entry = {"version": version, "spans": spans}
+    entry.update(mtime=mtime, blob=blob_id)
+    if cache is not None:
+        cache[key] = entry
+    return entry["version"], [tuple(i) for i in entry["spans"]]
+
+
+def component_version(src, cache_file=None):
+    """
+    Return the version of a brainvisa-cmake component given its source
+    directory. Results are memoized in a cache file.
+    """
+    if cache_file is None:
+        cache_file = user_cache_dir() / "components-versions.json"
+    cache = read_cache(cache_file)
+    before = {k: v.copy() for k, v in cache.items()}
+    version, _ = read_version(version_file(src), cache)
+    if cache != before:
+        write_cache(cache_file, cache)
+    return version
+
+
+def set_component_version(src, version):
+    """
+    Return a (file, content) tuple where content is the new content of the
+    version file of a component where version is replaced by the given one
+    (a tuple of integers).
+    """
+    file = version_file(src)
+    with open(file) as f:
+        content = f.read()
+    spans = version_spans(file, content)
+    if len(spans) == 1:
+        values = [".".join(str(i) for i in version)]
+    else:
+        values = [str(i) for i in version]
+    for (start, end), value in reversed(list(zip(spans, values))):
+        content = content[:start] + value + content[end:]
+    return file, content
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from .index import iter_subdirs, write_atomic
+
+"""
+State of a channel directory stored in .neuro-forge/state.json. It records
+the files of the channel with their size, modification time and sha256 as
+well as the modification time of subdirs (e.g. linux-64) and of their
+shards directory. In these directories, files are only created, renamed
+or removed (never modified in place), therefore a directory whose
+modification time did not change since the last scan is not listed again.
+Other files (at top level or in other directories, e.g. icons) are all
+stat'ed at each scan. The sha256 of a file is only computed when its size
+or modification time changed. Hidden files (such as temporary files of
+atomic writes), the content of .neuro-forge and .cache directories and
+directories inside subdirs (except shards) are ignored. The state also
+keeps, for each publication target, the files that were last published.
+"""
+
+ignored_directories = {".neuro-forge", ".cache"}
+
+
+def state_file(channel_dir):
+    return Path(channel_dir) / ".neuro-forge" / "state.json"
+
+
+def read_state(channel_dir):
+    file = state_file(channel_dir)
+    if file.exists():
+        with open(file) as f:
+            return json.load(f)
+    return {}
+
+
+def write_state(channel_dir, state):
+    file = state_file(channel_dir)
+    file.parent.mkdir(exist_ok=True)
+    write_atomic(file, json.dumps(state, indent=4, sort_keys=True))
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_files(directory, prefix, old_files, files, full):
+    """
+    Add the files directly contained in directory to files. Information
+    from old_files is reused for files whose size and modification time did
+    not change unless full is True.
+    """
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            path = f"{prefix}{entry.name}"
+            st = entry.stat()
+            old = old_files.get(path)
+            if (
+                not full
+                and old
+                and old["size"] == st.st_size
+                and old["mtime"] == st.st_mtime_ns
+            ):
+                files[path] = old
+            else:
+                files[path] = {
+                    "size": st.st_size,
+                    "mtime": st.st_mtime_ns,
+                    "sha256": file_sha256(entry.path),
+                }
+
+
+def scan_channel(channel_dir, state, full=False, subdirs=None):
+    """
+    Return the files and directories of a channel as they are stored in the
+    state: files is a dictionary whose keys are paths relative to
+    channel_dir and values are dictionaries with "size", "mtime" and
+    "sha256" items ; directories is a dictionary whose keys are relative
+    paths of subdirs and their shards directory and values are modification
+    times. Information from state is reused for unchanged subdirs and files
+    unless full is True. If subdirs is given, only these subdirs are
+    scanned and information from state is used for all other files.
+    """
+    channel_dir = Path(channel_dir)
+    old_files = state.get("files", {})
+    old_directories = state.get("directories", {})
+    if subdirs is None:
+        subdirs = [i.name for i in iter_subdirs(channel_dir) if i.is_dir()]
+        files = {}
+        directories = {}
+        for root, dirs, names in os.walk(channel_dir):
+            rel_dir = os.path.relpath(root, channel_dir)
+            prefix = "" if rel_dir == "." else f"{rel_dir}/"
+            if not prefix:
+                dirs[:] = [
+                    i for i in dirs if i not in ignored_directories and i not in subdirs
+                ]
+            scan_files(root, prefix, old_files, files, full)
+    else:
+        files = {
+            k: v for k, v in old_files.items() if k.split("/", 1)[0] not in subdirs
+        }
+        directories = {
+            k: v
+            for k, v in old_directories.items()
+            if k.split("/", 1)[0] not in subdirs
+        }
+    for subdir in subdirs:
+        for rel_dir in (subdir, f"{subdir}/shards"):
+            directory = channel_dir / rel_dir
+            if not directory.is_dir():
+                continue
+            prefix = f"{rel_dir}/"
+            mtime = directory.stat().st_mtime_ns
+            directories[rel_dir] = mtime
+            if not full and old_directories.get(rel_dir) == mtime:
+                files.update(
+                    (k, v)
+                    for k, v in old_files.items()
+                    if k.startswith(prefix) and "/" not in k[len(prefix) :]
+                )
+            else:
+                scan_files(directory, prefix, old_files, files, full)
+    return files, directories
+
+
+def diff_files(old, new):
+    """
+    Compare two files dictionaries (where values must contain "sha256") and
+    return a (added, modified, removed) tuple of sorted path lists.
+    """
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    modified = sorted(
+        i for i in set(new) & set(old) if new[i]["sha256"] != old[i]["sha256"]
+    )
+    return added, modified, removed
+
+
+def is_package_file(path):
+    return path.endswith(".conda") or path.endswith(".tar.bz2")
@@ -0,0 +1,52 @@
+import io
+import json
+import tarfile
+import zipfile
+
+import pytest
+import zstandard
+
+
+def write_conda(path, name, version, build="0", **fields):
+    """
+    Write a minimal .conda archive only containing info/index.json. Extra
+    fields (e.g. build_number, depends or timestamp) are added to
+    index.json.
+    """
+    index = {
+        "name": name,
+        "version": version,
+        "build": build,
+        "build_number": 0,
+        "subdir": path.parent.name,
+        "depends": [],
+    }
+    index.update(fields)
+    index = json.dumps(index).encode()
+    tar_content = io.BytesIO()
+    with tarfile.open(fileobj=tar_content, mode="w") as tar:
+        info = tarfile.TarInfo("info/index.json")
+        info.size = len(index)
+        tar.addfile(info, io.BytesIO(index))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr(
+            f"info-{path.name[: -len('.conda')]}.tar.zst",
+            zstandard.ZstdCompressor().compress(tar_content.getvalue()),
+        )
+    return path
+
+
+@pytest.fixture
+def channel(tmp_path):
+    """
+    Channel directory containing two versions of a package and another
+    package in linux-64
+    """
+    channel_dir = tmp_path / "channel"
+    (channel_dir / "noarch").mkdir(parents=True)
+    for name, version in (("a", "1.0"), ("a", "1.1"), ("b", "2.0")):
+        write_conda(
+            channel_dir / "linux-64" / f"{name}-{version}-0.conda", name, version
+        )
+    return channel_dir
@@ -0,0 +1,180 @@
+import json
+import os
+import types
+
+from click.testing import CliRunner
+import pytest
+import yaml
+
+from neuro_forge.soma_forge.commands import apply_plan as module
+from neuro_forge.soma_forge.commands import cli
+from neuro_forge.soma_forge.commands.apply_plan import (
+    action_dependencies,
+    append_journal,
+    read_journal,
+    stage_components,
+)
+
+
+def test_journal(tmp_path):
+    journal_file = tmp_path / "journal.jsonl"
+    assert read_journal(journal_file) == {}
+    append_journal(journal_file, {"action": "a", "status": "success"})
+    append_journal(journal_file, {"action": "a", "status": "failure"})
+    append_journal(journal_file, {"action": 1, "status": "success"})
+    assert read_journal(journal_file) == {
+        "a": {"action": "a", "status": "failure"},
+        "1": {"action": 1, "status": "success"},
+    }
+
+
+def test_journal_after_crash(tmp_path):
+    journal_file = tmp_path / "journal.jsonl"
+    append_journal(journal_file, {"action": "a", "status": "success"})
+    # Partial record written during a crash
+    with open(journal_file, "a") as f:
+        f.write('{"action": "b", "sta')
+    assert list(read_journal(journal_file)) == ["a"]
+
+    append_journal(journal_file, {"action": "b", "status": "success"})
+    append_journal(journal_file, {"action": "c", "status": "success"})
+    assert list(read_journal(journal_file)) == ["a", "b", "c"]
+    with open(journal_file) as f:
+        assert all(json.loads(line) for line in f)
+
+
+def test_journal_skips_invalid_lines(tmp_path):
+    journal_file = tmp_path / "journal.jsonl"
+    journal_file.write_text(
+        '{"action": "a", "status": "success"}\n'
+        "garbage\n"
+        "[]\n"
+        '{"action": "b", "status": "success"}\n'
+    )
+    assert list(read_journal(journal_file)) == ["a", "b"]
+
+
+def test_action_dependencies():
+    assert action_dependencies(
+        [
+            {"id": "check", "action": "check_build_status"},
+            {"id": "build:a", "action": "create_package", "depends": ["check"]},
+            {"id": "build:b", "action": "create_package", "depends": ["check"]},
+            {"action": "publish"},
+            {"action": "rebuild"},
+        ]
+    ) == {
+        "check": [],
+        "build:a": ["check"],
+        "build:b": ["check"],
+        "3": ["build:b"],
+        "4": ["3"],
+    }
+
+
+@pytest.fixture
+def plan(tmp_path, monkeypatch):
+    """
+    Plan directory whose actions call a fake action recording its calls
+    """
+    (tmp_path / "plan").mkdir()
+    calls = []
+
+    def fake_action(context, name, fail=False):
+        calls.append(name)
+        if fail:
+            raise ValueError(f"{name} failed")
+
+    monkeypatch.setattr(module, "fake_action", fake_action, raising=False)
+
+    def write_actions(actions):
+        with open(tmp_path / "plan" / "actions.yaml", "w") as f:
+            yaml.safe_dump(actions, f)
+
+    return tmp_path, write_actions, calls
+
+
+def test_apply_plan_resume(plan):
+    directory, write_actions, calls = plan
+    actions = [
+        {"id": "a", "action": "fake_action", "args": ["a"]},
+        {"id": "b", "action": "fake_action", "args": ["b"], "depends": ["a"]},
+        {"id": "c", "action": "fake_action", "args": ["c"], "depends": ["b"]},
+        {"id": "d", "action": "fake_action", "args": ["d"], "status": "success"},
+    ]
+    actions[1]["kwargs"] = {"fail": True}
+    write_actions(actions)
+    result = CliRunner().invoke(cli, ["apply-plan", str(directory)])
+    assert result.exit_code == 1
+    assert calls == ["a", "b"]
+    journal = read_journal(directory / "plan" / "journal.jsonl")
+    assert journal["a"]["status"] == "success"
+    assert journal["b"]["status"] == "failure"
+    assert journal["b"]["error"] == "ValueError: b failed"
+    assert "c" not in journal
+
+    # Only actions that did not succeed are run again
+    del actions[1]["kwargs"]
+    write_actions(actions)
+    calls.clear()
+    result = CliRunner().invoke(cli, ["apply-plan", "-j", "2", str(directory)])
+    assert result.exit_code == 0, result.output
+    assert calls == ["b", "c"]
+
+
+fake_make = """#!/bin/bash
+# Install a text file, a link and a binary file for each install target
+set -e
+for target in "$@"; do
+    dir="$BRAINVISA_INSTALL_PREFIX/share/$target"
+    mkdir -p "$dir"
+    echo "prefix=$BRAINVISA_INSTALL_PREFIX" > "$dir/conf"
+    ln -sfn "$dir/conf" "$dir/link"
+    if [ -n "$FAKE_MAKE_BINARY" ]; then
+        printf "bin\\0$BRAINVISA_INSTALL_PREFIX" > "$dir/bin"
+    fi
+done
+"""
+
+fake_pixi = """#!/bin/bash
+# pixi run --manifest-path <file> command...
+shift 3
+exec "$@"
+"""
+
+
+@pytest.fixture
+def stage_context(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, content in (("make", fake_make), ("pixi", fake_pixi)):
+        (bin_dir / name).write_text(content)
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("CASA_BUILD", str(tmp_path))
+    (tmp_path / "plan").mkdir()
+    return types.SimpleNamespace(pixi_root=tmp_path)
+
+
+def test_stage_components(stage_context):
+    stage_components(stage_context, ["soma-base", "capsul"])
+    stage_dir = stage_context.pixi_root / "plan" / "stage"
+    with open(stage_dir / "manifest.json") as f:
+        manifest = json.load(f)
+    assert sorted(manifest) == ["capsul", "soma-base"]
+    assert "share/install-soma-base-dev/conf" in manifest["soma-base"]
+    assert "share/install-soma-base-dev/link" in manifest["soma-base"]
+    assert not any("capsul" in i for i in manifest["soma-base"])
+    link = stage_dir / "soma-base" / "share" / "install-soma-base" / "link"
+    assert os.readlink(link) == "conf"
+
+
+def test_stage_components_not_relocatable(stage_context, monkeypatch, capsys):
+    monkeypatch.setenv("FAKE_MAKE_BINARY", "1")
+    with pytest.raises(ValueError, match="10 staged files"):
+        stage_components(stage_context, ["soma-base", "capsul"])
+    stage_dir = stage_context.pixi_root / "plan" / "stage"
+    assert (
+        f"ERROR: {stage_dir}/capsul/share/install-capsul/bin: binary file"
+        in capsys.readouterr().err
+    )
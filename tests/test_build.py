@@ -0,0 +1,56 @@
+import os
+import sys
+
+from click.testing import CliRunner
+
+import neuro_forge
+
+fake_rattler_build = f"""#!{sys.executable}
+import os, pathlib, sys
+sys.path.insert(0, {os.path.dirname(__file__)!r})
+from conftest import write_conda
+
+if sys.argv[1] == "--version":
+    print("rattler-build 0.0.0")
+    sys.exit()
+recipe = pathlib.Path(sys.argv[sys.argv.index("-r") + 1])
+output = pathlib.Path(sys.argv[sys.argv.index("--output-dir") + 1])
+with open(os.environ["FAKE_RATTLER_BUILD_LOG"], "a") as f:
+    print(
+        recipe.name,
+        os.environ["HOME"],
+        os.environ["RATTLER_CACHE_DIR"],
+        os.readlink(output / "src_cache"),
+        file=f,
+    )
+write_conda(output / "noarch" / f"{{recipe.name}}-1.0-0.conda", recipe.name, "1.0")
+"""
+
+
+def test_build_shares_cache(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "rattler-build").write_text(fake_rattler_build)
+    (bin_dir / "rattler-build").chmod(0o755)
+    log = tmp_path / "rattler-build.log"
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_RATTLER_BUILD_LOG", str(log))
+    monkeypatch.delenv("NEURO_FORGE_CACHE_DIR", raising=False)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    channel = tmp_path / "channel"
+    result = CliRunner().invoke(
+        neuro_forge.main,
+        ["build", "-j", "2", str(channel), "deidentification", "dracopy"],
+    )
+    assert result.exit_code == 0, result.output
+    calls = sorted(line.split() for line in log.read_text().splitlines())
+    assert [i[0] for i in calls] == ["deidentification", "dracopy"]
+    for name, home, rattler_cache, src_cache in calls:
+        # Only HOME and the output directory are specific to a build
+        assert home == str(channel / "bld" / "jobs" / name)
+        assert rattler_cache == str(channel / ".cache" / "rattler")
+        assert src_cache == str(channel / ".cache" / "src_cache")
+    assert (channel / "noarch" / "dracopy-1.0-0.conda").exists()
+    assert not (channel / ".cache").exists()
+    assert not (channel / "bld").exists()
@@ -0,0 +1,57 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from neuro_forge.soma_forge.commands.packaging_plan import get_test_commands
+
+pytestmark = pytest.mark.skipif(
+    not (shutil.which("cmake") and shutil.which("ctest")), reason="requires cmake"
+)
+
+
+@pytest.fixture
+def build_dir(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "CMakeLists.txt").write_text(
+        "cmake_minimum_required(VERSION 3.14)\n"
+        "project(test NONE)\n"
+        "enable_testing()\n"
+        'add_test(NAME a COMMAND echo "hello world")\n'
+        'set_tests_properties(a PROPERTIES LABELS "axon;soma")\n'
+        "add_test(NAME unlabeled COMMAND true)\n"
+        "add_subdirectory(sub)\n"
+    )
+    (src / "sub" / "CMakeLists.txt").write_text(
+        "add_test(NAME b COMMAND echo b)\n"
+        "set_tests_properties(b PROPERTIES LABELS soma)\n"
+    )
+    build = tmp_path / "build"
+    subprocess.check_call(
+        ["cmake", "-S", str(src), "-B", str(build)], stdout=subprocess.DEVNULL
+    )
+    return build
+
+
+def test_get_test_commands(build_dir):
+    echo = shutil.which("echo")
+    expected = {
+        "axon": [f"{echo} 'hello world'"],
+        "soma": [f"{echo} 'hello world'", f"{echo} b"],
+    }
+    log_lines = []
+    assert get_test_commands(log_lines, build_dir=build_dir) == expected
+    assert log_lines[0] == "$ ctest --show-only=json-v1"
+    assert (build_dir / "ctest-commands.json").exists()
+
+    log_lines = []
+    assert get_test_commands(log_lines, build_dir=build_dir) == expected
+    assert log_lines[0].startswith("Using test commands cached in")
+
+    # Modifying a CTestTestfile.cmake invalidates the cache
+    os.utime(build_dir / "sub" / "CTestTestfile.cmake")
+    log_lines = []
+    assert get_test_commands(log_lines, build_dir=build_dir) == expected
+    assert log_lines[0] == "$ ctest --show-only=json-v1"
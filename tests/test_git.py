@@ -0,0 +1,176 @@
+import subprocess
+
+import pytest
+
+from neuro_forge.soma_forge.git import (
+    check_merge_needed,
+    find_repositories,
+    iter_branches,
+    iter_mirrors,
+    iter_tags,
+    mirror_path,
+    remote_refs,
+    sync_repository,
+    update_mirror,
+)
+
+
+def git(*args, cwd=None):
+    return subprocess.check_output(["git", *args], cwd=cwd, text=True).strip()
+
+
+def commit(work_tree, name, content):
+    (work_tree / name).write_text(content)
+    git("add", name, cwd=work_tree)
+    git("commit", "-q", "-m", f"Add {name}", cwd=work_tree)
+    return git("rev-parse", "HEAD", cwd=work_tree)
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    """
+    Bare repository with a master branch containing one commit. Git
+    configuration of the user is ignored.
+    """
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    for variable in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{variable}_NAME", "test")
+        monkeypatch.setenv(f"GIT_{variable}_EMAIL", "test@example.com")
+    bare = tmp_path / "remote.git"
+    git("init", "-q", "--bare", "-b", "master", str(bare))
+    work_tree = tmp_path / "upstream"
+    git("clone", "-q", str(bare), str(work_tree))
+    git("checkout", "-q", "-b", "master", cwd=work_tree)
+    commit(work_tree, "a.txt", "a")
+    git("push", "-q", "origin", "master", cwd=work_tree)
+    return bare
+
+
+def push_commit(remote, tmp_path, name):
+    work_tree = tmp_path / "upstream"
+    sha = commit(work_tree, name, name)
+    git("push", "-q", "origin", "master", cwd=work_tree)
+    return sha
+
+
+def test_check_merge_needed(remote, tmp_path):
+    clone = tmp_path / "src" / "component"
+    git("clone", "-q", str(remote), str(clone))
+    git("checkout", "-q", "-b", "feature", cwd=clone)
+
+    report = check_merge_needed(clone)
+    assert report["status"] == "ok"
+    assert report["branch"] == "master"
+    assert report["commands"] == []
+
+    push_commit(remote, tmp_path, "b.txt")
+    report = check_merge_needed(clone)
+    assert report["status"] == "merge"
+    assert report["commands"] == [
+        f"git -C '{clone}' merge --no-edit origin/master",
+        f"git -C '{clone}' push",
+    ]
+
+    git("merge", "-q", "--no-edit", "origin/master", cwd=clone)
+    assert check_merge_needed(clone)["status"] == "ok"
+
+
+def test_check_merge_needed_error(remote, tmp_path):
+    clone = tmp_path / "component"
+    git("clone", "-q", str(remote), str(clone))
+    git("remote", "set-url", "origin", str(tmp_path / "missing.git"), cwd=clone)
+    report = check_merge_needed(clone)
+    assert report["status"] == "error"
+    assert report["error"]
+
+
+def test_find_repositories(remote, tmp_path):
+    src = tmp_path / "src"
+    for path in ("a", "group/b", "group/b/sub/c", "ignored/d", "x/y/z/e"):
+        git("clone", "-q", str(remote), str(src / path))
+    found = list(find_repositories(src, max_depth=3, ignore=["ignored"]))
+    assert found == [src / "a", src / "group" / "b"]
+
+
+def test_sync_repository(remote, tmp_path):
+    url = f"file://{remote}"
+    dest = tmp_path / "src" / "component"
+    report = sync_repository(url, "master", dest)
+    assert (report["action"], report["status"]) == ("clone", "ok")
+    assert report["size"] > 0
+    assert git("config", "remote.origin.partialclonefilter", cwd=dest) == "blob:none"
+    assert (dest / "a.txt").read_text() == "a"
+
+    sha = push_commit(remote, tmp_path, "b.txt")
+    report = sync_repository(url, "master", dest)
+    assert (report["action"], report["status"]) == ("update", "ok")
+    assert git("rev-parse", "HEAD", cwd=dest) == sha
+
+    # A working tree on another branch is only fetched
+    git("checkout", "-q", "-b", "feature", cwd=dest)
+    push_commit(remote, tmp_path, "c.txt")
+    assert sync_repository(url, "master", dest)["status"] == "ok"
+    assert git("rev-parse", "HEAD", cwd=dest) == sha
+    assert not (dest / "c.txt").exists()
+
+
+def test_sync_repository_shallow(remote, tmp_path):
+    push_commit(remote, tmp_path, "b.txt")
+    dest = tmp_path / "component"
+    report = sync_repository(f"file://{remote}", "master", dest, shallow=True)
+    assert report["status"] == "ok"
+    assert git("rev-list", "--count", "HEAD", cwd=dest) == "1"
+
+
+def test_sync_repository_error(remote, tmp_path):
+    report = sync_repository(
+        f"file://{remote}", "missing-branch", tmp_path / "component"
+    )
+    assert (report["action"], report["status"]) == ("clone", "error")
+    assert "missing-branch" in report["error"]
+
+
+def test_mirror(remote, tmp_path):
+    url = f"file://{remote}"
+    mirror_dir = tmp_path / "mirrors"
+    report = update_mirror(mirror_dir, url)
+    assert (report["action"], report["status"]) == ("clone", "ok")
+    mirror = mirror_path(mirror_dir, url)
+    assert report["path"] == str(mirror)
+    assert mirror.name.endswith(".git") and "remote-" in mirror.name
+    assert list(iter_mirrors(mirror_dir)) == [url]
+
+    sha = push_commit(remote, tmp_path, "b.txt")
+    report = update_mirror(mirror_dir, url)
+    assert (report["action"], report["status"]) == ("update", "ok")
+    assert git("rev-parse", "master", cwd=mirror) == sha
+
+    # Clones use the objects of the mirror
+    dest = tmp_path / "component"
+    assert sync_repository(url, "master", dest, reference=mirror)["status"] == "ok"
+    alternates = dest / ".git" / "objects" / "info" / "alternates"
+    assert alternates.read_text().strip() == str(mirror / "objects")
+    assert git("rev-parse", "HEAD", cwd=dest) == sha
+
+
+def test_remote_refs(remote, tmp_path):
+    url = str(remote)
+    cache_file = tmp_path / "remote-refs.json"
+    git("tag", "-a", "-m", "release", "v1.0", cwd=tmp_path / "upstream")
+    git("push", "-q", "origin", "v1.0", cwd=tmp_path / "upstream")
+    refs = remote_refs(url, cache_file=cache_file)
+    assert "refs/heads/master" in refs and "refs/tags/v1.0" in refs
+
+    # Cached refs are used until ttl is reached
+    sha = push_commit(remote, tmp_path, "b.txt")
+    assert remote_refs(url, cache_file=cache_file) == refs
+    assert remote_refs(url, ttl=0, cache_file=cache_file)["refs/heads/master"] == sha
+
+
+def test_iter_tags_and_branches(remote, tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    git("tag", "-a", "-m", "release", "v1.0", cwd=tmp_path / "upstream")
+    git("push", "-q", "origin", "v1.0", "master:other", cwd=tmp_path / "upstream")
+    assert sorted(iter_branches(str(remote))) == ["master", "other"]
+    assert list(iter_tags(str(remote))) == ["v1.0"]
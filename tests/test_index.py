@@ -0,0 +1,110 @@
+import hashlib
+import json
+
+import msgpack
+import zstandard
+
+from neuro_forge.index import (
+    add_packages,
+    check_subdir,
+    index_channel,
+    index_subdir,
+    read_repodata,
+)
+
+from conftest import write_conda
+
+
+def test_index_channel(channel):
+    result = index_channel(channel)
+    assert result == {
+        "noarch": ([], []),
+        "linux-64": (["a-1.0-0.conda", "a-1.1-0.conda", "b-2.0-0.conda"], []),
+    }
+    for subdir in ("noarch", "linux-64"):
+        assert check_subdir(channel / subdir) == []
+    repodata = read_repodata(channel / "linux-64")
+    assert repodata["packages.conda"]["a-1.1-0.conda"]["version"] == "1.1"
+    with open(channel / "linux-64" / "current_repodata.json") as f:
+        current = json.load(f)
+    assert sorted(current["packages.conda"]) == ["a-1.1-0.conda", "b-2.0-0.conda"]
+
+
+def test_index_subdir_is_incremental(channel):
+    subdir = channel / "linux-64"
+    index_subdir(subdir)
+    assert index_subdir(subdir) == ([], [])
+
+    write_conda(subdir / "c-1.0-0.conda", "c", "1.0")
+    (subdir / "b-2.0-0.conda").unlink()
+    assert index_subdir(subdir) == (["c-1.0-0.conda"], ["b-2.0-0.conda"])
+    assert check_subdir(subdir) == []
+    assert sorted(read_repodata(subdir)["packages.conda"]) == [
+        "a-1.0-0.conda",
+        "a-1.1-0.conda",
+        "c-1.0-0.conda",
+    ]
+
+
+def test_index_subdir_force(channel):
+    subdir = channel / "linux-64"
+    index_subdir(subdir)
+    added, removed = index_subdir(subdir, force=True)
+    assert len(added) == 3 and removed == []
+
+
+def test_check_subdir_errors(channel):
+    subdir = channel / "linux-64"
+    assert check_subdir(subdir) == [f"{subdir}: missing repodata.json"]
+
+    index_subdir(subdir)
+    (subdir / "repodata.json.zst").unlink()
+    shard = next((subdir / "shards").iterdir())
+    shard.write_bytes(b"corrupted")
+    errors = check_subdir(subdir)
+    assert f"{subdir / 'repodata.json.zst'}: missing" in errors
+    assert f"{shard}: invalid sha256" in errors
+
+
+def test_add_packages(channel, tmp_path):
+    index_channel(channel)
+    build_dir = tmp_path / "build"
+    write_conda(build_dir / "noarch" / "d-1.0-0.conda", "d", "1.0")
+    assert add_packages(channel, build_dir) == ["noarch/d-1.0-0.conda"]
+    assert not (build_dir / "noarch" / "d-1.0-0.conda").exists()
+    assert "d-1.0-0.conda" in read_repodata(channel / "noarch")["packages.conda"]
+    assert check_subdir(channel / "noarch") == []
+
+
+def test_check_subdir_invalid_content(channel):
+    subdir = channel / "linux-64"
+    index_subdir(subdir)
+    (subdir / "repodata.json.zst").write_bytes(b"garbage")
+    (subdir / "current_repodata.json").write_text("{")
+    errors = check_subdir(subdir)
+    assert len(errors) == 2
+    assert errors[0].startswith(f"{subdir / 'repodata.json.zst'}: invalid content")
+    assert errors[1].startswith(f"{subdir / 'current_repodata.json'}: invalid content")
+
+    # Shard whose sha256 is valid but whose content is not
+    compressor = zstandard.ZstdCompressor()
+    index_file = subdir / "repodata_shards.msgpack.zst"
+    decompressor = zstandard.ZstdDecompressor()
+    index = msgpack.unpackb(decompressor.decompress(index_file.read_bytes()))
+    shard = compressor.compress(b"garbage")
+    digest = hashlib.sha256(shard).digest()
+    (subdir / "shards" / f"{digest.hex()}.msgpack.zst").write_bytes(shard)
+    index["shards"]["a"] = digest
+    index_file.write_bytes(compressor.compress(msgpack.packb(index)))
+    assert any(
+        i.startswith(f"{subdir / 'shards' / digest.hex()}.msgpack.zst: invalid content")
+        for i in check_subdir(subdir)
+    )
+
+    index_file.write_bytes(b"garbage")
+    assert f"{index_file}: invalid content" in check_subdir(subdir)[-1]
+
+    (subdir / "repodata.json").write_text("garbage")
+    assert check_subdir(subdir)[0].startswith(
+        f"{subdir / 'repodata.json'}: invalid content"
+    )
@@ -0,0 +1,14 @@
+from neuro_forge.manifest import is_up_to_date, read_manifest, write_manifest
+
+
+def test_manifest(channel):
+    assert read_manifest(channel) == {}
+    manifest = {"a": {"fingerprint": "f", "files": ["linux-64/a-1.1-0.conda"]}}
+    write_manifest(channel, manifest)
+    assert read_manifest(channel) == manifest
+    assert [i.name for i in (channel / ".neuro-forge").iterdir()] == ["build.json"]
+    assert is_up_to_date(channel, manifest, "a", "f")
+    assert not is_up_to_date(channel, manifest, "a", "g")
+    assert not is_up_to_date(channel, manifest, "b", "f")
+    (channel / "linux-64" / "a-1.1-0.conda").unlink()
+    assert not is_up_to_date(channel, manifest, "a", "f")
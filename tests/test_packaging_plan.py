@@ -0,0 +1,196 @@
+import json
+
+from click.testing import CliRunner
+import pytest
+import yaml
+
+from neuro_forge.soma_forge import recipes as recipes_module
+from neuro_forge.soma_forge.commands import cli
+from neuro_forge.soma_forge.commands import packaging_plan as module
+from neuro_forge.soma_forge.commands.packaging_plan import (
+    dependency_pins,
+    package_fingerprint,
+)
+from neuro_forge.soma_forge.recipes import RecipeGraph
+
+
+def recipe(name, type="compiled", dependencies=()):
+    return {
+        "package": {"name": name, "version": "0.0.0"},
+        "soma-forge": {
+            "type": type,
+            "components": [] if type == "virtual" else [name],
+            "internal-dependencies": list(dependencies),
+        },
+        "requirements": {"run": []},
+    }
+
+
+def test_dependency_pins():
+    recipes = {
+        "a": recipe("a"),
+        "v": recipe("v", type="virtual"),
+    }
+    recipes["a"]["package"]["version"] = "1.2.3"
+    r = recipe("b", dependencies=["a", "v", "c"])
+    release_history = {"c": {"version": "4.5.6"}}
+    # Virtual packages are pinned by fingerprint, other packages by version
+    assert dependency_pins(r, recipes, {"a": "fa", "v": "fv"}, release_history) == {
+        "a": "1.2.3",
+        "v": "fv",
+        "c": "4.5.6",
+    }
+    assert dependency_pins(r, recipes, {}, {}) == {
+        "a": "1.2.3",
+        "v": "0.0.0",
+        "c": None,
+    }
+
+
+def test_package_fingerprint():
+    fingerprint = package_fingerprint("recipe", {"a": "c1"}, {"b": "1.0"}, "py312")
+    assert fingerprint == package_fingerprint(
+        "recipe", {"a": "c1"}, {"b": "1.0"}, "py312"
+    )
+    assert len({
+        fingerprint,
+        package_fingerprint("other", {"a": "c1"}, {"b": "1.0"}, "py312"),
+        package_fingerprint("recipe", {"a": "c2"}, {"b": "1.0"}, "py312"),
+        package_fingerprint("recipe", {"a": "c1"}, {"b": "1.1"}, "py312"),
+        package_fingerprint("recipe", {"a": "c1"}, {"b": "1.0"}, "py313"),
+        package_fingerprint("recipe", None, {"b": "1.0"}, "py312"),
+    }) == 6
+
+
+@pytest.fixture
+def forge(tmp_path, monkeypatch):
+    """
+    Pixi directory and publication directory for a development environment
+    with compiled packages a and b (depending on a) and a virtual package v
+    depending on b. Returns a function running packaging-plan and returning
+    the list of selected packages and the release history to publish.
+    """
+    graph = RecipeGraph(
+        [
+            recipe("a"),
+            recipe("b", dependencies=["a"]),
+            recipe("v", type="virtual", dependencies=["b"]),
+        ]
+    )
+    monkeypatch.setattr(recipes_module, "_recipe_graph", graph)
+    monkeypatch.setattr(module, "recipe_graph", lambda: graph)
+    sources = {
+        "a": {"commit": "a1", "version": "0.1.0"},
+        "b": {"commit": "b1", "version": "0.2.0"},
+    }
+    monkeypatch.setattr(
+        module, "component_version", lambda src: sources[src.name]["version"]
+    )
+    monkeypatch.setattr(
+        module,
+        "scan_repositories",
+        lambda paths: {
+            src: {
+                "modified": False,
+                "untracked": False,
+                "commit": sources[src.name]["commit"],
+                "seconds": 0.0,
+            }
+            for src in paths
+        },
+    )
+    pixi_root = tmp_path / "pixi"
+    (pixi_root / "conf").mkdir(parents=True)
+    (pixi_root / "conf" / "build_info.json").write_text(
+        json.dumps(
+            {
+                "environment": "0.1",
+                "build_string": "py312",
+                "all_packages": ["a", "b", "v"],
+                "options": {"python": "3.12"},
+            }
+        )
+    )
+    publication_dir = tmp_path / "public"
+    publication_dir.mkdir()
+
+    def packaging_plan():
+        result = CliRunner().invoke(
+            cli,
+            [
+                "packaging-plan",
+                "--force",
+                "--publication-directory",
+                str(publication_dir),
+                str(pixi_root),
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        with open(pixi_root / "plan" / "actions.yaml") as f:
+            actions = yaml.safe_load(f)
+        publish = [i for i in actions if i["id"] == "publish"]
+        if not publish:
+            return [], None
+        kwargs = publish[0]["kwargs"]
+        return kwargs["packages"][1:], kwargs["release_history"]
+
+    def publish(release_history):
+        (publication_dir / "soma-env-0.1.json").write_text(json.dumps(release_history))
+
+    return sources, packaging_plan, publish
+
+
+def test_packaging_plan_no_change(forge):
+    sources, packaging_plan, publish = forge
+    selected, release_history = packaging_plan()
+    assert selected == ["a", "b", "v"]
+    assert release_history["environment_version"] == "0.1.0"
+    publish(release_history)
+
+    # Nothing changed since the publication: the plan is empty
+    assert packaging_plan() == ([], None)
+
+    # Releases published before fingerprints were recorded are up to date
+    for package in ("a", "b"):
+        del release_history[package]["fingerprint"]
+    publish(release_history)
+    assert packaging_plan() == ([], None)
+
+
+def test_packaging_plan_virtual(forge):
+    sources, packaging_plan, publish = forge
+    selected, release_history = packaging_plan()
+    publish(release_history)
+
+    # A new commit in b does not change the pins of v
+    sources["b"]["commit"] = "b2"
+    selected, release_history = packaging_plan()
+    assert selected == ["b"]
+    publish(release_history)
+
+    # A new version of b changes the pins of v
+    sources["b"]["commit"] = "b3"
+    sources["b"]["version"] = "0.2.1"
+    selected, release_history = packaging_plan()
+    assert selected == ["b", "v"]
+    assert release_history["environment_version"] == "0.1.2"
+
+
+def test_packaging_plan_recipe_change(forge, monkeypatch):
+    sources, packaging_plan, publish = forge
+    selected, release_history = packaging_plan()
+    publish(release_history)
+
+    # A change in the recipe of a is detected by its fingerprint and
+    # propagated to b that is compiled and depends on a
+    graph = RecipeGraph(
+        [
+            dict(recipe("a"), about={"summary": "changed"}),
+            recipe("b", dependencies=["a"]),
+            recipe("v", type="virtual", dependencies=["b"]),
+        ]
+    )
+    monkeypatch.setattr(recipes_module, "_recipe_graph", graph)
+    monkeypatch.setattr(module, "recipe_graph", lambda: graph)
+    selected, release_history = packaging_plan()
+    assert selected == ["a", "b"]
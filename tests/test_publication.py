@@ -0,0 +1,81 @@
+import json
+import os
+
+from neuro_forge.index import index_channel
+from neuro_forge.publication import LocalTransport, manifest_path, publish_files
+from neuro_forge.state import scan_channel
+
+
+def published_content(directory):
+    result = {}
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            path = os.path.join(root, file)
+            result[os.path.relpath(path, directory)] = open(path, "rb").read()
+    return result
+
+
+def publish(channel, remote, retention=3):
+    files, _ = scan_channel(channel, {})
+    with LocalTransport(str(remote)) as transport:
+        sent = publish_files(transport, channel, files, retention=retention)
+    return files, sent
+
+
+def test_publish_and_update(channel, tmp_path):
+    index_channel(channel)
+    remote = tmp_path / "published" / "channel"
+    remote.parent.mkdir()
+
+    files, sent = publish(channel, remote)
+    assert sent == sorted(files)
+    assert os.path.islink(remote)
+    content = published_content(remote)
+    with open(remote / manifest_path) as f:
+        assert sorted(json.load(f)) == sorted(files)
+    del content[manifest_path]
+    assert content == published_content(channel)
+
+    # Only modified files and repodata are sent again
+    (channel / "linux-64" / "b-2.0-0.conda").unlink()
+    (channel / "noarch" / "readme.txt").write_text("new")
+    first_generation = os.readlink(remote)
+    files, sent = publish(channel, remote)
+    assert "noarch/readme.txt" in sent
+    assert "linux-64/a-1.0-0.conda" not in sent
+    assert all(
+        i == "noarch/readme.txt" or os.path.basename(i).startswith("repodata")
+        for i in sent
+    )
+    assert os.readlink(remote) != first_generation
+    assert not (remote / "linux-64" / "b-2.0-0.conda").exists()
+    # Unchanged files are hard links to the previous generation
+    assert (
+        os.stat(remote / "linux-64" / "a-1.0-0.conda").st_ino
+        == os.stat(os.path.join(first_generation, "linux-64", "a-1.0-0.conda")).st_ino
+    )
+    # The previous generation is left untouched
+    assert os.path.exists(os.path.join(first_generation, "linux-64", "b-2.0-0.conda"))
+
+
+def test_generations_retention(channel, tmp_path):
+    remote = tmp_path / "published"
+    # Publications in the same second must not use the same generation
+    for i in range(4):
+        (channel / "index.html").write_text(str(i))
+        publish(channel, remote, retention=2)
+    generations = sorted(os.listdir(tmp_path / "published-generations"))
+    assert len(generations) == 2
+    assert os.readlink(remote).endswith(generations[-1])
+    assert (remote / "index.html").read_text() == "3"
+
+
+def test_legacy_directory_is_moved(channel, tmp_path):
+    remote = tmp_path / "published"
+    remote.mkdir()
+    (remote / "old.txt").write_text("old")
+    publish(channel, remote)
+    assert os.path.islink(remote)
+    assert not (remote / "old.txt").exists()
+    generations = os.listdir(tmp_path / "published-generations")
+    assert "00000000-000000" in generations
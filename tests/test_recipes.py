@@ -0,0 +1,100 @@
+import pytest
+
+from neuro_forge.soma_forge.recipes import (
+    CycleError,
+    RecipeGraph,
+    rebuild_impact,
+    recipe_graph,
+)
+
+
+def recipe(name, type="compiled", dependencies=()):
+    return {
+        "package": {"name": name, "version": "1.0.0"},
+        "soma-forge": {
+            "type": type,
+            "components": [name],
+            "internal-dependencies": list(dependencies),
+        },
+    }
+
+
+@pytest.fixture
+def graph():
+    return RecipeGraph(
+        [
+            recipe("d", dependencies=["b", "c"]),
+            recipe("c", type="interpreted", dependencies=["a"]),
+            recipe("b", dependencies=["a"]),
+            recipe("a"),
+            recipe("e", type="virtual", dependencies=["d"]),
+        ]
+    )
+
+
+def test_topological_order(graph):
+    assert graph.names == ("a", "b", "c", "d", "e")
+    assert [[i.name for i in level] for level in graph.levels()] == [
+        ["a"],
+        ["b", "c"],
+        ["d"],
+        ["e"],
+    ]
+    assert graph.dependencies("d", transitive=True) == ("a", "b", "c")
+    assert graph.dependents("a") == ("b", "c")
+    assert graph.dependents("b", transitive=True) == ("d", "e")
+
+
+def test_select(graph):
+    assert [i.name for i in graph.select(["d"])] == ["a", "b", "c", "d"]
+    assert [i.name for i in graph.select(["all", "-e"])] == ["a", "b", "c", "d"]
+    with pytest.raises(ValueError, match="Unknown soma-forge package: z"):
+        graph.select(["z"])
+
+
+def test_recipes_are_immutable(graph):
+    with pytest.raises(TypeError):
+        graph["a"].recipe["package"]["name"] = "z"
+    copy = graph.recipe("a")
+    copy["package"]["name"] = "z"
+    assert graph["a"].recipe["package"]["name"] == "a"
+
+
+def test_cycle():
+    with pytest.raises(CycleError) as e:
+        RecipeGraph(
+            [
+                recipe("a", dependencies=["c"]),
+                recipe("b", dependencies=["a"]),
+                recipe("c", dependencies=["b"]),
+                recipe("d"),
+            ]
+        )
+    assert e.value.packages == ["a", "c", "b"]
+    assert str(e.value) == (
+        "Dependency cycle between soma-forge packages: a -> c -> b -> a"
+    )
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError, match="Unknown internal dependencies for a: z"):
+        RecipeGraph([recipe("a", dependencies=["z"])])
+
+
+def test_rebuild_impact(graph):
+    # Only compiled packages depending on compiled packages are rebuilt
+    impact = rebuild_impact({"a": "source changed"}, graph=graph)
+    assert impact == {
+        "a": [("a", "source changed")],
+        "b": [("b", "depends on a"), ("a", "source changed")],
+        "d": [("d", "depends on b"), ("b", "depends on a"), ("a", "source changed")],
+    }
+    assert list(rebuild_impact({"a": "x"}, candidates={"a", "d"}, graph=graph)) == [
+        "a"
+    ]
+
+
+def test_soma_forge_recipes():
+    graph = recipe_graph()
+    for node in graph:
+        assert all(graph[i].index < node.index for i in node.dependencies)
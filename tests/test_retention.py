@@ -0,0 +1,120 @@
+import json
+
+from neuro_forge.index import index_channel
+from neuro_forge.retention import (
+    is_development,
+    package_rules,
+    protected_builds,
+    select_obsolete,
+)
+
+from conftest import write_conda
+
+day = 86400
+now = 1000 * day
+
+
+def add_builds(channel, name, version, build_string, build_numbers, **fields):
+    for build_number in build_numbers:
+        build = f"{build_string}_{build_number}"
+        write_conda(
+            channel / "linux-64" / f"{name}-{version}-{build}.conda",
+            name,
+            version,
+            build,
+            build_number=build_number,
+            **fields,
+        )
+
+
+def obsolete(channel, rules):
+    index_channel(channel)
+    return sorted(i[1] for i in select_obsolete(channel, rules, now=now))
+
+
+def test_keep(channel):
+    # Build numbers 10 and 11 come before 8 and 9 in file name order
+    add_builds(channel, "a", "1.1", "h1", (8, 9, 10, 11))
+    add_builds(channel, "a", "1.1", "h2", (0,))
+    add_builds(channel, "a", "1.0", "h1", (0, 1))
+    assert obsolete(channel, {}) == ["a-1.1-h1_8.conda"]
+    assert obsolete(channel, {"keep": 2}) == ["a-1.1-h1_8.conda", "a-1.1-h1_9.conda"]
+    assert obsolete(channel, {"keep": None}) == []
+
+
+def test_package_rules():
+    rules = {"keep": 2, "packages": {"soma-*": {"keep": 1}, "soma-env": {"keep": 5}}}
+    assert package_rules(rules, "a") == {"keep": 2, "dev_max_age": None}
+    assert package_rules(rules, "soma-base") == {"keep": 1, "dev_max_age": None}
+    assert package_rules(rules, "soma-env") == {"keep": 5, "dev_max_age": None}
+
+
+def test_protected_builds(channel):
+    (channel / "soma-env-0.1.json").write_text(
+        json.dumps(
+            {
+                "environment_version": "0.1.3",
+                "a": {"version": "1.1", "build_string": "h1_8"},
+                "b": {"version": "2.0"},
+                "release_date": "2024-01-01",
+            }
+        )
+    )
+    assert protected_builds(channel) == {
+        ("soma-env", "0.1.3", None),
+        ("a", "1.1", "h1_8"),
+        ("b", "2.0", None),
+    }
+
+
+def test_protected_builds_are_kept(channel):
+    add_builds(channel, "a", "1.1", "h1", (8, 9, 10, 11))
+    add_builds(channel, "soma-env", "0.1", "h0", (0, 1, 2, 3))
+    (channel / "soma-env-0.1.json").write_text(
+        json.dumps(
+            {
+                "environment_version": "0.1",
+                "a": {"version": "1.1", "build_string": "h1_8"},
+            }
+        )
+    )
+    # Protected builds do not count in the number of kept builds
+    assert obsolete(channel, {"keep": 1}) == [
+        "a-1.1-h1_10.conda",
+        "a-1.1-h1_9.conda",
+    ]
+
+
+def test_is_development():
+    assert is_development({"name": "soma-env", "version": "0.1"})
+    assert not is_development({"name": "soma-env", "version": "1.0"})
+    assert is_development({"name": "a", "version": "1.0", "depends": ["soma-env 0.1"]})
+    assert is_development(
+        {"name": "a", "version": "1.0", "depends": ["soma-env >=0.1,<0.2"]}
+    )
+    assert not is_development(
+        {"name": "a", "version": "1.0", "depends": ["soma-env >=1.0,<1.1"]}
+    )
+    assert not is_development({"name": "a", "version": "1.0", "depends": ["b"]})
+
+
+def test_dev_max_age(channel):
+    old = (now - 40 * day) * 1000
+    recent = (now - 5 * day) * 1000
+    add_builds(channel, "soma-env", "0.1", "h0", (0,), timestamp=old)
+    add_builds(channel, "soma-env", "1.0", "h0", (0,), timestamp=old)
+    add_builds(
+        channel, "c", "1.0", "h0", (0,), timestamp=old, depends=["soma-env >=0.1"]
+    )
+    add_builds(
+        channel, "c", "1.1", "h0", (0,), timestamp=recent, depends=["soma-env >=0.1"]
+    )
+    assert obsolete(channel, {}) == []
+    assert obsolete(channel, {"dev_max_age": 30}) == [
+        "c-1.0-h0_0.conda",
+        "soma-env-0.1-h0_0.conda",
+    ]
+    (channel / "soma-env-0.1.json").write_text(
+        json.dumps({"environment_version": "0.1"})
+    )
+    assert obsolete(channel, {"dev_max_age": 30}) == ["c-1.0-h0_0.conda"]
@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+from neuro_forge.scheduler import run_jobs
+
+
+def test_dependencies_run_first():
+    order = []
+
+    def run(name):
+        order.append(name)
+        return True
+
+    status = run_jobs({"c": ["b"], "b": ["a"], "a": []}, run, jobs=4)
+    assert order == ["a", "b", "c"]
+    assert status == {"a": "success", "b": "success", "c": "success"}
+
+
+def test_failure_cancels_dependents_only():
+    def run(name):
+        return name != "a"
+
+    status = run_jobs(
+        {"a": [], "b": ["a"], "c": ["b"], "d": [], "e": ["d"]}, run, jobs=2
+    )
+    assert status == {
+        "a": "failure",
+        "b": "cancelled",
+        "c": "cancelled",
+        "d": "success",
+        "e": "success",
+    }
+
+
+def test_exception_is_a_failure():
+    def run(name):
+        if name == "a":
+            raise RuntimeError("build failed")
+        return True
+
+    status = run_jobs({"a": [], "b": ["a"]}, run)
+    assert status == {"a": "failure", "b": "cancelled"}
+
+
+def test_jobs_limit():
+    lock = threading.Lock()
+    running = []
+    maximum = []
+
+    def run(name):
+        with lock:
+            running.append(name)
+            maximum.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(name)
+        return True
+
+    run_jobs({str(i): [] for i in range(8)}, run, jobs=3)
+    assert max(maximum) <= 3
+
+
+def test_cycle():
+    with pytest.raises(ValueError, match="cycle"):
+        run_jobs({"a": ["b"], "b": ["a"]}, lambda name: True)
@@ -0,0 +1,86 @@
+import os
+
+from neuro_forge.index import index_channel
+from neuro_forge.state import diff_files, scan_channel
+
+
+def test_scan_channel(channel):
+    (channel / "icons").mkdir()
+    (channel / "icons" / "logo.png").write_bytes(b"png")
+    (channel / "index.html").write_text("channel")
+    (channel / ".neuro-forge").mkdir()
+    (channel / ".neuro-forge" / "state.json").write_text("{}")
+    (channel / ".cache").mkdir()
+    (channel / ".cache" / "file").write_text("cache")
+    (channel / "linux-64" / ".a-1.0-0.conda.tmp").write_text("partial")
+
+    files, directories = scan_channel(channel, {})
+    assert sorted(files) == [
+        "icons/logo.png",
+        "index.html",
+        "linux-64/a-1.0-0.conda",
+        "linux-64/a-1.1-0.conda",
+        "linux-64/b-2.0-0.conda",
+    ]
+    assert sorted(directories) == ["linux-64", "noarch"]
+
+
+def test_file_rewritten_in_place(channel):
+    index = channel / "index.html"
+    index.write_text("old")
+    files, directories = scan_channel(channel, {})
+    directory_mtime = os.stat(channel).st_mtime_ns
+
+    with open(index, "r+") as f:
+        f.write("new")
+    os.utime(channel, ns=(directory_mtime, directory_mtime))
+    new_files, _ = scan_channel(
+        channel, {"files": files, "directories": directories}
+    )
+    assert diff_files(files, new_files) == ([], ["index.html"], [])
+
+
+def test_unchanged_subdir_is_not_scanned(channel):
+    state = {}
+    state["files"], state["directories"] = scan_channel(channel, state)
+    # Entries of a subdir whose modification time did not change are reused
+    # as they are, even if they are wrong.
+    state["files"]["linux-64/b-2.0-0.conda"]["sha256"] = "unchanged"
+    files, _ = scan_channel(channel, state)
+    assert files["linux-64/b-2.0-0.conda"]["sha256"] == "unchanged"
+    files, _ = scan_channel(channel, state, full=True)
+    assert files["linux-64/b-2.0-0.conda"]["sha256"] != "unchanged"
+
+    # Adding a file changes the modification time of the subdir but only
+    # new or modified files are hashed.
+    (channel / "linux-64" / "c.txt").write_text("c")
+    files, _ = scan_channel(channel, state)
+    assert files["linux-64/b-2.0-0.conda"]["sha256"] == "unchanged"
+    assert "linux-64/c.txt" in files
+
+
+def test_scan_reindexed_subdirs(channel):
+    state = {}
+    state["files"], state["directories"] = scan_channel(channel, state)
+    index_channel(channel, subdirs=["linux-64"])
+    (channel / "index.html").write_text("not scanned")
+    files, directories = scan_channel(channel, state, subdirs=["linux-64"])
+    assert "index.html" not in files
+    assert "linux-64/repodata.json" in files
+    assert any(i.startswith("linux-64/shards/") for i in files)
+    assert "linux-64/shards" in directories
+    full_scan, _ = scan_channel(channel, {})
+    del full_scan["index.html"]
+    assert files == full_scan
+
+
+def test_diff_files(channel):
+    files, _ = scan_channel(channel, {})
+    (channel / "linux-64" / "a-1.0-0.conda").unlink()
+    (channel / "noarch" / "new.txt").write_text("new")
+    (channel / "linux-64" / "b-2.0-0.conda").write_bytes(b"rebuilt")
+    assert diff_files(files, scan_channel(channel, {"files": files})[0]) == (
+        ["noarch/new.txt"],
+        ["linux-64/b-2.0-0.conda"],
+        ["linux-64/a-1.0-0.conda"],
+    )
@@ -0,0 +1,64 @@
+import pytest
+
+from neuro_forge.soma_forge.versions import component_version, set_component_version
+
+
+@pytest.mark.parametrize(
+    "file, content, version, new_content",
+    [
+        (
+            "pyproject.toml",
+            '[tool.x]\nversion = "0.0.1"\n[project]\nname = "x"\nversion = "5.2.1"\n',
+            "5.2.1",
+            '[tool.x]\nversion = "0.0.1"\n[project]\nname = "x"\nversion = "5.2.2"\n',
+        ),
+        (
+            "python/soma/info.py",
+            "# é\nversion_major = 5\nversion_minor = 2\nversion_micro = 1\n",
+            "5.2.1",
+            "# é\nversion_major = 5\nversion_minor = 2\nversion_micro = 2\n",
+        ),
+        (
+            "project_info.cmake",
+            "set( BRAINVISA_PACKAGE_VERSION_MAJOR 5 )\n"
+            "set( BRAINVISA_PACKAGE_VERSION_MINOR 2 )\n"
+            "set( BRAINVISA_PACKAGE_VERSION_PATCH 1 )\n",
+            "5.2.1",
+            "set( BRAINVISA_PACKAGE_VERSION_MAJOR 5 )\n"
+            "set( BRAINVISA_PACKAGE_VERSION_MINOR 2 )\n"
+            "set( BRAINVISA_PACKAGE_VERSION_PATCH 2 )\n",
+        ),
+    ],
+)
+def test_component_version(tmp_path, file, content, version, new_content):
+    src = tmp_path / "src"
+    (src / file).parent.mkdir(parents=True)
+    (src / file).write_text(content)
+    cache_file = tmp_path / "versions.json"
+    assert component_version(src, cache_file) == version
+    assert cache_file.exists()
+    assert component_version(src, cache_file) == version
+
+    version_file, content = set_component_version(src, (5, 2, 2))
+    assert version_file == src / file
+    assert content == new_content
+    version_file.write_text(content)
+    assert component_version(src, cache_file) == "5.2.2"
+
+
+def test_info_py_is_not_executed(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "info.py").write_text(
+        "raise RuntimeError()\n"
+        "version_major = 1\nversion_minor = 0\nversion_micro = 3\n"
+    )
+    assert component_version(src, tmp_path / "versions.json") == "1.0.3"
+
+
+def test_missing_version(tmp_path):
+    with pytest.raises(ValueError, match="Cannot find component version file"):
+        component_version(tmp_path, tmp_path / "versions.json")
+    (tmp_path / "pyproject.toml").write_text('[project]\nname = "x"\n')
+    with pytest.raises(ValueError, match="Cannot find version"):
+        component_version(tmp_path, tmp_path / "versions.json")